@@ -0,0 +1,111 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from bench_serving import load_prompts, run_config
+
+# Throughput of server_openai.py as a proxy, without Azure: server_mock.py stands in for the Azure OpenAI endpoint
+# and server_openai.py is pointed at it. A proxy that overlaps its upstream calls gains requests/s with every
+# concurrency step until --upstream-concurrency or the stand-in's --slots is reached; one that serializes them
+# stays flat at 1 / upstream latency.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark server_openai.py against a local stand-in for Azure OpenAI")
+    parser.add_argument('--concurrency', default="1,4,16,64", help="Comma-separated concurrency levels to sweep (default: 1,4,16,64)")
+    parser.add_argument('--requests', type=int, default=200, help="Measured requests per level (default: 200)")
+    parser.add_argument('--warmup', type=int, default=4, help="Unmeasured requests before each level (default: 4)")
+    parser.add_argument('--mode', default="base", choices=["base", "cot"], help="Prompt mode; cot replies are longer, so the upstream is slower (default: base)")
+    parser.add_argument('--max-tokens', type=int, default=256, help="max_tokens of every request (default: 256)")
+    parser.add_argument('--datasets', default="Amazon,Blog,Persona", help="Comma-separated datasets whose questions make up the prompt mix")
+    parser.add_argument('--model', default="GPT-4o-mini", help="Deployment name passed to server_openai.py (default: GPT-4o-mini)")
+    parser.add_argument('--upstream-concurrency', type=int, default=64, help="--upstream-concurrency of server_openai.py (default: 64)")
+    parser.add_argument('--upstream-ttft-ms', type=float, default=200.0, help="Simulated upstream time to first token (default: 200)")
+    parser.add_argument('--upstream-tokens-per-s', type=float, default=100.0, help="Simulated upstream decode rate (default: 100)")
+    parser.add_argument('--upstream-slots', type=int, default=256, help="Requests the stand-in serves at once (default: 256)")
+    parser.add_argument('--proxy-port', type=int, default=4100, help="Port of server_openai.py (default: 4100)")
+    parser.add_argument('--upstream-port', type=int, default=4101, help="Port of the stand-in (default: 4101)")
+    parser.add_argument('--timeout', type=float, default=600.0, help="Per-request timeout in seconds (default: 600)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the prompt shuffle")
+    parser.add_argument('--output', help="Where to save the JSON results (default: results/bench/openai_proxy_<timestamp>.json)")
+    return parser
+
+def start(script, args, cwd, log_path):
+    log = open(log_path, 'w', encoding='utf-8')
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script)] + args, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_until_listening(port, process, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server on port {port} exited with code {process.returncode}")
+        try:
+            requests.get(f"http://localhost:{port}/docs", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not come up within {timeout}s")
+
+def main():
+    args = get_parser().parse_args()
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+    prompts = load_prompts(args.datasets.split(","), args.mode == "cot", args.seed)
+
+    # Both servers run in a scratch directory, so their cost.json and request logs stay out of the tree
+    workdir = tempfile.mkdtemp(prefix="bench_openai_proxy_")
+    upstream = start("server_mock.py", [
+        "--port", str(args.upstream_port), "--slots", str(args.upstream_slots), "--ttft-ms", str(args.upstream_ttft_ms),
+        "--tokens-per-s", str(args.upstream_tokens_per_s), "--jitter", "0",
+    ], workdir, os.path.join(workdir, "upstream.log"))
+    proxy = start("server_openai.py", [
+        "--model", args.model, "--port", str(args.proxy_port), "--azure-endpoint", f"http://localhost:{args.upstream_port}",
+        "--api-version", "2024-06-01", "--api-key", "bench", "--upstream-concurrency", str(args.upstream_concurrency),
+    ], workdir, os.path.join(workdir, "proxy.log"))
+
+    results = []
+    try:
+        wait_until_listening(args.upstream_port, upstream)
+        wait_until_listening(args.proxy_port, proxy)
+        url = f"http://localhost:{args.proxy_port}/v1/chat/completions"
+        for concurrency in concurrency_levels:
+            result = run_config(url, prompts, concurrency, args.max_tokens, args.requests, args.warmup, args.timeout)
+            result["concurrency"] = concurrency
+            results.append(result)
+            speedup = result["requests_per_s"] / results[0]["requests_per_s"] if results[0]["requests_per_s"] and result["requests_per_s"] else None
+            print(f"concurrency={concurrency}: {result['requests_per_s'] or 0:.2f} req/s "
+                  f"({f'{speedup:.1f}x' if speedup else 'n/a'} vs concurrency {concurrency_levels[0]}), "
+                  f"p50 {result['latency']['p50'] or 0:.3f}s, p99 {result['latency']['p99'] or 0:.3f}s, error rate {result['error_rate']:.1%}")
+    finally:
+        for process in (proxy, upstream):
+            process.terminate()
+            process.wait()
+
+    report = {
+        "meta": {
+            "mode": args.mode,
+            "max_tokens": args.max_tokens,
+            "upstream_concurrency": args.upstream_concurrency,
+            "upstream_ttft_ms": args.upstream_ttft_ms,
+            "upstream_tokens_per_s": args.upstream_tokens_per_s,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "requests_per_config": args.requests,
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join("results", "bench", f"openai_proxy_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    print(f"Saved results to {output}; server logs in {workdir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from eval_metrics import percentile
+from eval_plan import ORDER_LIST, EvalPlan
+
+# Closed-loop load test of a chat completions server (server_vllm.py, server_openai.py or server_mock.py)
+# with the real MotiveBench prompt mix. Every configuration of the sweep keeps `concurrency` requests in
+# flight until `--requests` have completed; results are saved as JSON so serving changes can be compared.
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Load test and throughput benchmark for the serving layer")
+    parser.add_argument('--url', default="http://localhost:4000/v1/chat/completions", help="Chat completions endpoint to drive")
+    parser.add_argument('--datasets', default="Amazon,Blog,Persona", help="Comma-separated datasets whose questions make up the prompt mix")
+    parser.add_argument('--concurrency', default="1,4,16,64", help="Comma-separated concurrency levels to sweep")
+    parser.add_argument('--modes', default="base,cot", help="Comma-separated prompt modes to sweep (base, cot)")
+    parser.add_argument('--max-tokens', default="4096", help="Comma-separated max_tokens values to sweep")
+    parser.add_argument('--requests', type=int, default=200, help="Measured requests per configuration (default: 200)")
+    parser.add_argument('--warmup', type=int, default=4, help="Unmeasured requests before each configuration (default: 4)")
+    parser.add_argument('--timeout', type=float, default=600.0, help="Per-request timeout in seconds (default: 600)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the prompt shuffle")
+    parser.add_argument('--output', help="Where to save the JSON results (default: results/bench/serving_<timestamp>.json)")
+    parser.add_argument('--baseline', help="Earlier JSON results to compare saturation throughput against")
+    return parser
+
+def load_prompts(datasets, cot, seed):
+    current_directory = os.getcwd()
+    prompts = []
+    for dataset in datasets:
+        input_file_path = os.path.join(current_directory, dataset, f"{dataset}_questions.json")
+        plan = EvalPlan.load_or_build(input_file_path, cot, ORDER_LIST, os.path.join(current_directory, "results", "plans"))
+        for item in plan:
+            for questions in item.prompts:
+                prompts.extend(questions)
+    random.Random(seed).shuffle(prompts)
+    return prompts
+
+def send(session, url, prompt, max_tokens, timeout):
+    data = {
+        "messages": [
+            {"role": "system", "content": "You ara a helpful AI assistant."},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.0,
+        "top_p": 1.0,
+        "repetition_penalty": 1.05,
+    }
+    start = time.perf_counter()
+    try:
+        response = session.post(url, json=data, timeout=timeout)
+    except requests.RequestException as e:
+        return {"ok": False, "latency": time.perf_counter() - start, "error": type(e).__name__}
+    latency = time.perf_counter() - start
+    if response.status_code != 200:
+        return {"ok": False, "latency": latency, "error": str(response.status_code)}
+    result = response.json()
+    if isinstance(result, dict) and "error" in result:
+        # Older server_vllm.py versions report a failed generation as a 200 with an error body
+        return {"ok": False, "latency": latency, "error": "error_body"}
+    usage = result.get("usage") if isinstance(result, dict) else None
+    return {
+        "ok": True,
+        "latency": latency,
+        "ttfb": response.elapsed.total_seconds(),
+        "completion_tokens": usage.get("completion_tokens") if usage else None,
+    }
+
+def run_config(url, prompts, concurrency, max_tokens, num_requests, warmup, timeout):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    prompt_iter = itertools.cycle(prompts)
+    lock = threading.Lock()
+    remaining = [warmup]
+
+    def worker():
+        samples = []
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return samples
+                remaining[0] -= 1
+                prompt = next(prompt_iter)
+            samples.append(send(session, url, prompt, max_tokens, timeout))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: worker(), range(concurrency)))
+        remaining[0] = num_requests
+        start = time.perf_counter()
+        futures = [executor.submit(worker) for _ in range(concurrency)]
+        samples = [sample for future in futures for sample in future.result()]
+        elapsed = time.perf_counter() - start
+
+    ok = [s for s in samples if s["ok"]]
+    latencies = sorted(s["latency"] for s in ok)
+    ttfbs = sorted(s["ttfb"] for s in ok)
+    completion_tokens = sum(s["completion_tokens"] for s in ok if s["completion_tokens"] is not None)
+    errors = {}
+    for s in samples:
+        if not s["ok"]:
+            errors[s["error"]] = errors.get(s["error"], 0) + 1
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": (len(samples) - len(ok)) / len(samples) if samples else 0.0,
+        "elapsed": elapsed,
+        "requests_per_s": len(ok) / elapsed if elapsed > 0 else None,
+        "tokens_per_s": completion_tokens / elapsed if elapsed > 0 and completion_tokens else None,
+        "latency": {f"p{q}": percentile(latencies, q) for q in (50, 90, 95, 99)},
+        "ttfb": {f"p{q}": percentile(ttfbs, q) for q in (50, 95, 99)},
+    }
+
+def main():
+    args = get_parser().parse_args()
+    datasets = args.datasets.split(",")
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+    max_tokens_values = [int(m) for m in args.max_tokens.split(",")]
+
+    results = []
+    saturation = {}
+    for mode in args.modes.split(","):
+        prompts = load_prompts(datasets, mode == "cot", args.seed)
+        for max_tokens in max_tokens_values:
+            for concurrency in concurrency_levels:
+                result = run_config(args.url, prompts, concurrency, max_tokens, args.requests, args.warmup, args.timeout)
+                result.update({"mode": mode, "max_tokens": max_tokens, "concurrency": concurrency})
+                results.append(result)
+                print(f"{mode} max_tokens={max_tokens} concurrency={concurrency}: "
+                      f"{result['requests_per_s'] or 0:.2f} req/s, p50 {result['latency']['p50'] or 0:.3f}s, "
+                      f"p99 {result['latency']['p99'] or 0:.3f}s, error rate {result['error_rate']:.1%}")
+
+            # Saturation: the best sustained throughput over the concurrency sweep, and where it was reached
+            sweep = [r for r in results if r["mode"] == mode and r["max_tokens"] == max_tokens and r["requests_per_s"]]
+            if sweep:
+                best = max(sweep, key=lambda r: r["requests_per_s"])
+                saturation[f"{mode}/{max_tokens}"] = {"requests_per_s": best["requests_per_s"], "concurrency": best["concurrency"]}
+
+    report = {
+        "meta": {
+            "url": args.url,
+            "datasets": datasets,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "requests_per_config": args.requests,
+        },
+        "saturation": saturation,
+        "results": results,
+    }
+    output = args.output or os.path.join("results", "bench", f"serving_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    print(f"Saved results to {output}")
+
+    for key, value in saturation.items():
+        print(f"Saturation {key}: {value['requests_per_s']:.2f} req/s at concurrency {value['concurrency']}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)["saturation"]
+        for key, value in saturation.items():
+            if key in baseline:
+                change = value["requests_per_s"] / baseline[key]["requests_per_s"] - 1
+                print(f"  {key} vs baseline: {change:+.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Startup cost of the client-side scripts: wall time of a fresh interpreter importing the module, peak RSS of that
+# process, and which heavy ML libraries got pulled in. Exits non-zero when a budget is exceeded, so it can guard
+# against an import-time dependency creeping back in.
+
+HEAVY_MODULES = ["torch", "transformers", "vllm"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"import_s": time.perf_counter() - start, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Startup time and peak RSS benchmark of the client scripts")
+    parser.add_argument('--modules', default="client_eval,bench_serving", help="Comma-separated modules to import (default: client_eval,bench_serving)")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per module; the median is reported (default: 5)")
+    parser.add_argument('--max-seconds', type=float, default=1.0, help="Fail if the median startup exceeds this wall time (default: 1.0)")
+    parser.add_argument('--max-rss-mb', type=float, default=200.0, help="Fail if the peak RSS exceeds this many MiB (default: 200)")
+    parser.add_argument('--output', help="Also save the results as JSON to this path")
+    return parser
+
+def measure(module):
+    # Wall time includes interpreter startup; the rusage of the reaped child gives its own peak RSS (KiB on Linux)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+    output = process.stdout.read().decode()
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{output}")
+    return {"wall_s": wall, "peak_rss_mb": rusage.ru_maxrss / 1024, **json.loads(output.strip().splitlines()[-1])}
+
+def main():
+    args = get_parser().parse_args()
+    results = {}
+    failed = False
+    for module in args.modules.split(","):
+        runs = [measure(module) for _ in range(args.runs)]
+        result = {
+            "wall_s": statistics.median(r["wall_s"] for r in runs),
+            "import_s": statistics.median(r["import_s"] for r in runs),
+            "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+            "heavy": runs[-1]["heavy"],
+        }
+        results[module] = result
+        print(f"{module}: startup {result['wall_s']:.3f}s (import {result['import_s']:.3f}s), peak RSS {result['peak_rss_mb']:.1f} MiB, "
+              f"heavy modules: {', '.join(result['heavy']) or 'none'}")
+        if result["wall_s"] > args.max_seconds:
+            print(f"  FAIL: startup above {args.max_seconds:.3f}s")
+            failed = True
+        if result["heavy"]:
+            print(f"  FAIL: imports {', '.join(result['heavy'])} at startup")
+            failed = True
+        if result["peak_rss_mb"] > args.max_rss_mb:
+            print(f"  FAIL: peak RSS above {args.max_rss_mb:.1f} MiB")
+            failed = True
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,33 @@
 import requests
 import json
 import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-import transformers
-import torch
 import os
-from vllm import LLM, SamplingParams
+import time
+
+from eval_cache import ResponseCache
+from eval_journal import EvalJournal
+from eval_metrics import EvalMetrics
+from eval_extract import AnswerExtractor, is_answer_line
+from eval_plan import ORDER_LIST, EvalPlan, chat_messages, parse_options
+from eval_retry import CircuitBreaker, RetryPolicy
 
 
 SERVER_URL = "http://localhost:{}/v1/chat/completions"  # Dynamic port in the URL
+BATCH_URL = "http://localhost:{}/v1/chat/completions/batch"
+PREFIX_STATS_URL = "http://localhost:{}/v1/prefix_cache_stats"
+session = None  # Shared keep-alive HTTP session, created on first request
+retry_policy = None  # Backoff and circuit breaker shared by all workers
+cache = None  # Response cache, None when disabled with --no-cache
+extractor = None  # Rule-based answer extraction cascade
+parse_pipeline = None  # Parse model, only loaded once a reply is too ambiguous for the rules
+
+OPTION_LETTERS = ['A', 'B', 'C', 'D', 'E', 'F']
+PARSE_MODEL = "Qwen/Qwen2.5-7B-Instruct"
+PARSE_TEMPLATE = "Extract the letters of the option from the given text and return only ONE letter as the answer. The answer can only return **one character without any other explanation**."
 
 
 def get_parser():
@@ -18,49 +37,29 @@ def get_parser():
     parser.add_argument('--cot', action='store_true')
     parser.add_argument('--port', type=int, default=4000, help="Port to run the server on")
     parser.add_argument('--parse_mode', action='store_true', help="Enable parse mode (default: False)")
+    parser.add_argument('--scoring', default='generate', choices=['generate', 'logprob'], help="'generate' parses the answer from the generated reply; 'logprob' takes the argmax of the next-token log-probabilities of the option letters (base mode only)")
+    parser.add_argument('--constrained', action='store_true', help="Ask the server to constrain the answer letter with guided decoding, so no answer parsing is needed")
+    parser.add_argument('--parse_batch_size', type=int, default=16, help="Batch size of the parse model in parse mode (default: 16)")
+    parser.add_argument('--extract_threshold', type=float, default=0.75, help="Minimum confidence for a rule-based answer extraction to be accepted without the fallback (default: 0.75)")
+    parser.add_argument('--cache-dir', default=os.path.join("results", "cache"), help="Directory of the on-disk response cache (default: results/cache)")
+    parser.add_argument('--cache-max-mb', type=int, default=1024, help="Size budget of the response cache before LRU eviction (default: 1024)")
+    parser.add_argument('--no-cache', action='store_true', help="Always query the model and do not read or write the response cache")
+    parser.add_argument('--resume', action='store_true', help="Resume from the journal of a previous run, skipping questions that were already answered")
+    parser.add_argument('--schedule', default='order', choices=['order', 'item'], help="Dispatch order-major (default) or item-major, which sends all permutations of a question stem back to back for server prefix-cache reuse")
+    parser.add_argument('--batch_requests', type=int, default=0, help="Send up to N conversations per call to the /v1/chat/completions/batch endpoint (default: 0, one call per conversation)")
+    parser.add_argument('--stream', action='store_true', help="Receive replies as server-sent events, which also records the time to first token")
+    parser.add_argument('--stop_on_answer', action='store_true', help="With --stream, cancel the generation as soon as a complete line holds the final answer letter")
+    parser.add_argument('--pretokenize', action='store_true', help="Tokenize the whole plan with the --llm tokenizer ahead of the run and send token ids, so the server skips tokenization (server_vllm.py)")
+    parser.add_argument('--run_tag', default=None, help="Tag sent with every request (X-Run-Tag header) under which server_openai.py accounts the cost (default: the name of the result log)")
+    parser.add_argument('--quiet', action='store_true', help="Do not print every question and answer to stdout")
+    parser.add_argument('--concurrency', type=int, default=1, help="Number of requests kept in flight against the server (default: 1, serial)")
+    parser.add_argument('--max_retries', type=int, default=8, help="Retries of a request answered with 429/502/503/504 or a connection error before the run fails (default: 8)")
+    parser.add_argument('--retry_base_delay', type=float, default=1.0, help="Backoff before the first retry; doubles per attempt, fully jittered, never below the server's Retry-After (default: 1.0)")
+    parser.add_argument('--retry_max_delay', type=float, default=60.0, help="Cap of the backoff between retries in seconds (default: 60)")
+    parser.add_argument('--breaker_threshold', type=int, default=10, help="Consecutive failed attempts across all workers that pause every worker (default: 10)")
+    parser.add_argument('--breaker_cooldown', type=float, default=5.0, help="Seconds the workers stay paused before a single probe request is sent (default: 5)")
     return parser
 
-def load_questions(input_file, order):
-    with open(input_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        questions = []
-        answers = []
-
-        for item in data:
-            if args.cot:
-                question_1 = "The following is a Motivational Reasoning Question. Based on the content of the given question, please infer the most likely answer and output the answer index.\n\n" + item["Motivation Reasoning Question"] + "\nOptions: " + str(rearrange_options(item["Options 1"], order)) + "\n\nPlease first think step by step, conduct analysis on the answers to the questions, output the reasoning process, and finally output the most likely option letter. **The last line of your reply should only contain one character of your final choice.**"
-                question_2 = "The following is a Behavioral Reasoning Question. Based on the content of the given question, please infer the most likely answer and output the answer index.\n\n" + item["Behavior Reasoning Question"] + "\nOptions: " + str(rearrange_options(item["Options 2"], order)) + "\n\nPlease first think step by step, conduct analysis on the answers to the questions, output the reasoning process, and finally output the most likely option letter. **The last line of your reply should only contain one character of your final choice.**"
-                question_3 = "The following is a Motivational and Behavioral Reasoning Question. Based on the content of the given question, please infer the most likely answer and output the answer index.\n\n" + item["Motivation and Behavior Reasoning Question"] + "\nOptions: " + str(rearrange_options(item["Options 3"], order)) + "\n\nPlease first think step by step, conduct analysis on the answers to the questions, output the reasoning process, and finally output the most likely option letter. **The last line of your reply should only contain one character of your final choice.**"
-            else:
-                question_1 = "The following is a Motivational Reasoning Question. Based on the content of the given question, please infer the most likely answer and output the answer index.\n\n" + item["Motivation Reasoning Question"] + "\nOptions: " + str(rearrange_options(item["Options 1"], order)) + "\n\nPlease answer this multiple-choice question. The result can only return **one character without any other explanation**."
-                question_2 = "The following is a Behavioral Reasoning Question. Based on the content of the given question, please infer the most likely answer and output the answer index.\n\n" + item["Behavior Reasoning Question"] + "\nOptions: " + str(rearrange_options(item["Options 2"], order)) + "\n\nPlease answer this multiple-choice question. The result can only return **one character without any other explanation**."
-                question_3 = "The following is a Motivational and Behavioral Reasoning Question. Based on the content of the given question, please infer the most likely answer and output the answer index.\n\n" + item["Motivation and Behavior Reasoning Question"] + "\nOptions: " + str(rearrange_options(item["Options 3"], order)) + "\n\nPlease answer this multiple-choice question. The result can only return **one character without any other explanation**."
-            
-            correct_answer_1 = get_new_correct_answer(item["Correct Answer 1"], order)
-            correct_answer_2 = get_new_correct_answer(item["Correct Answer 2"], order)
-            correct_answer_3 = get_new_correct_answer(item["Correct Answer 3"], order)
-            questions.append([question_1, question_2, question_3])
-            answers.append([correct_answer_1, correct_answer_2, correct_answer_3])
-
-        return questions, answers
-
-def rearrange_options(options, order):
-    # List of alphabet letters to update the labels
-    labels = ['A', 'B', 'C', 'D', 'E', 'F']
-    # Rearranging the options based on the given order
-    rearranged_options = [options[i-1] for i in order]
-    # Updating the labels
-    updated_options = [f"{labels[i]}. {option.split('. ', 1)[1]}" for i, option in enumerate(rearranged_options)]
-    return updated_options
-
-def get_new_correct_answer(original_correct, order):
-    # Get the original index of the correct answer (A=0, B=1, etc.)
-    original_index = ord(original_correct) - ord('A')
-    # Find the new index of the correct answer based on the rearranged order
-    new_index = order.index(original_index + 1)
-    # Return the new correct letter
-    return chr(new_index + ord('A'))
-
 def save_answers(answers, output_file):
     with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(answers, f, ensure_ascii=False, indent=4)
@@ -74,25 +73,311 @@ def create_chat_request(messages, max_tokens):
         "repetition_penalty": 1.05,
     }
 
-def get_model_response(question):
+def get_session():
+    # One keep-alive session shared by all workers, with a connection pool sized to the in-flight window
+    global session
+    if session is None:
+        session = requests.Session()
+        pool_size = max(args.concurrency, 1)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if args.run_tag:
+            session.headers["X-Run-Tag"] = args.run_tag
+    return session
+
+def post(url, stats=None, **kwargs):
+    # Overloaded servers answer 429/503 with Retry-After; those are retried with backoff instead of failing the run
+    def count_retry():
+        if stats is not None:
+            stats["retries"] = stats.get("retries", 0) + 1
+    return retry_policy.call(lambda: get_session().post(url, **kwargs), count_retry)
+
+def build_request(question):
+    messages = chat_messages(question)
+    if args.scoring == 'logprob':
+        # A single forward pass scores the option letters; nothing is decoded
+        data = create_chat_request(messages, max_tokens=1)
+        data["logprob_choices"] = OPTION_LETTERS
+    else:
+        data = create_chat_request(messages, max_tokens=4096)
+        if args.constrained:
+            # The server guarantees the reply (base) or its last line (CoT) is exactly one option letter
+            data["allowed_choices"] = OPTION_LETTERS
+            data["reasoning"] = args.cot
+    return data
+
+def record_usage(result, stats):
+    usage = result.get("usage") if isinstance(result, dict) else None
+    if usage:
+        stats["prompt_tokens"] = usage.get("prompt_tokens")
+        stats["completion_tokens"] = usage.get("completion_tokens")
+
+def response_content(result):
+    # server_vllm.py answers with an OpenAI chat.completion object; the other servers return the bare content.
+    # Only the content (or the logprob scores) is cached and journaled, so anything else fails the request here,
+    # before it can be cached or journaled.
+    if isinstance(result, dict) and "error" in result:
+        raise Exception(f"Server reported an error: {result['error']}")
+    if isinstance(result, dict) and "choices" in result:
+        content = result["choices"][0].get("message", {}).get("content")
+        if not isinstance(content, str):
+            raise Exception(f"Server returned a completion without content: {result!r}")
+        result = content
+    elif isinstance(result, dict):
+        result = {k: v for k, v in result.items() if k != "usage"}
+    error = response_error(result)
+    if error is not None:
+        raise Exception(error)
+    return result
+
+def response_error(response):
+    # Why a cached, journaled or received reply cannot be scored in this run's mode, or None if it can
+    if args.scoring == 'logprob':
+        if not isinstance(response, dict) or "logprobs" not in response:
+            return f"Server does not support logprob scoring, got: {response!r}"
+    elif not isinstance(response, str):
+        return f"Server returned no content: {response!r}"
+    elif args.constrained and constrained_letter(response) not in OPTION_LETTERS:
+        return f"Server did not enforce the allowed choices, got: {response!r}"
+    return None
+
+def valid_response(response):
+    return response_error(response) is None
+
+def with_token_ids(data, token_ids):
+    # Pre-tokenized prompts travel next to the messages; they are not part of the cache key
+    return {**data, "prompt_token_ids": token_ids} if token_ids is not None else data
+
+def get_model_response(question, stats=None, token_ids=None):
+    # `stats`, if given, is filled with per-call details for the metrics sidecar
     url = SERVER_URL.format(args.port)  # Use the port from the command-line argument
     headers = {
         "Content-Type": "application/json"
     }
+    data = build_request(question)
+
+    if cache is not None:
+        # Replies cut short after their answer line are cached apart from complete ones. Replies cut at a bare
+        # letter (stop_on_answer: True) may have stopped at an option heading, so they are no longer reused.
+        key = cache.make_key(args.llm, {**data, "stop_on_answer": "answer_line"} if args.stop_on_answer else data)
+        # Entries that cannot be scored, e.g. error bodies cached by earlier versions, are asked again
+        cached = cache.get(key, valid_response)
+        if cached is not None:
+            if stats is not None:
+                stats["cached"] = True
+            return cached
 
-    messages = [
-        {"role": "system", "content": "You ara a helpful AI assistant."},
-        {"role": "user", "content": question}
-    ]
-    data = create_chat_request(messages, max_tokens=4096)
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    if args.stream:
+        sent = time.perf_counter()
+        response = post(url, stats, headers=headers, data=json.dumps({**with_token_ids(data, token_ids), "stream": True}), stream=True)
+        if response.status_code != 200:
+            raise Exception(f"Request failed with status code {response.status_code}: {response.text}")
+        result = response_content(read_stream(response, sent, stats if stats is not None else {}))
+        if stats is not None:
+            stats["ttfb"] = response.elapsed.total_seconds()
+        if cache is not None:
+            cache.put(key, result)
+        return result
+
+    response = post(url, stats, headers=headers, data=json.dumps(with_token_ids(data, token_ids)))
 
     if response.status_code == 200:
-        return response.json()
+        result = response.json()
+        if stats is not None:
+            # requests measures `elapsed` up to the parsed response headers, i.e. time to first byte
+            stats["ttfb"] = response.elapsed.total_seconds()
+            record_usage(result, stats)
+        result = response_content(result)
+        if cache is not None:
+            cache.put(key, result)
+        return result
     else:
         raise Exception(f"Request failed with status code {response.status_code}: {response.text}")
 
-    
+def read_stream(response, sent, stats):
+    # Assemble a reply from OpenAI-style server-sent events. With --stop_on_answer the connection is closed as
+    # soon as a complete line holds the final answer; the server then aborts the generation and frees its slot.
+    parts = []
+    scanned = ""  # text after the last complete line, not yet checked for an answer
+    done = False
+    try:
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            payload = line[len(b"data: "):]
+            if payload == b"[DONE]":
+                done = True
+                break
+            chunk = json.loads(payload)
+            if "error" in chunk:
+                raise Exception(f"Stream failed: {chunk['error']}")
+            record_usage(chunk, stats)
+            content = chunk["choices"][0]["delta"].get("content") if chunk.get("choices") else None
+            if not content:
+                continue
+            if "ttft" not in stats:
+                stats["ttft"] = time.perf_counter() - sent
+            parts.append(content)
+            if args.stop_on_answer:
+                *complete_lines, scanned = (scanned + content).split("\n")
+                if any(is_answer_line(l) for l in complete_lines):
+                    stats["stopped_early"] = True
+                    break
+    finally:
+        response.close()
+    reply = "".join(parts)
+    # A stream that broke off is not a complete reply, so it must not be cached or journaled
+    if not done and not stats.get("stopped_early"):
+        raise Exception(f"Stream ended without [DONE] after {len(reply)} characters")
+    return reply
+
+def get_model_responses_batch(jobs, on_response):
+    # Send the (key, question, token_ids) jobs in one call to the batch endpoint and hand every result to
+    # on_response(key, response, stats) as soon as its NDJSON line arrives
+    url = BATCH_URL.format(args.port)
+    pending = []
+    for key, question, token_ids in jobs:
+        data = build_request(question)
+        cache_key = cache.make_key(args.llm, data) if cache is not None else None
+        cached = cache.get(cache_key, valid_response) if cache is not None else None
+        if cached is not None:
+            on_response(key, cached, {"cached": True})
+        else:
+            pending.append((key, with_token_ids(data, token_ids), cache_key))
+    if not pending:
+        return
+
+    batch_stats = {}
+    response = post(url, batch_stats, json={"requests": [data for _, data, _ in pending], "stream": True}, stream=True)
+    if response.status_code != 200:
+        raise Exception(f"Request failed with status code {response.status_code}: {response.text}")
+
+    received = 0
+    for line in response.iter_lines():
+        if not line:
+            continue
+        entry = json.loads(line)
+        key, _, cache_key = pending[entry["index"]]
+        if "error" in entry:
+            raise Exception(f"Batch entry {key} failed: {entry['error']}")
+        stats = {"ttfb": response.elapsed.total_seconds(), **batch_stats}
+        # The retries belong to the batch call, so they are counted once, with its first entry
+        batch_stats.clear()
+        record_usage(entry["response"], stats)
+        result = response_content(entry["response"])
+        if cache is not None:
+            cache.put(cache_key, result)
+        on_response(key, result, stats)
+        received += 1
+    if received != len(pending):
+        raise Exception(f"Batch response ended after {received} of {len(pending)} entries")
+
+def get_prefix_cache_stats():
+    # Servers without prefix-cache accounting (e.g. server_openai.py) simply report nothing
+    try:
+        response = get_session().get(PREFIX_STATS_URL.format(args.port), timeout=10)
+    except requests.RequestException:
+        return None
+    return response.json() if response.status_code == 200 else None
+
+def report_prefix_cache_stats(before, after):
+    if before is None or after is None:
+        return
+    prompt_tokens = after["prompt_tokens"] - before["prompt_tokens"]
+    cached_tokens = after["cached_prompt_tokens"] - before["cached_prompt_tokens"]
+    hit_rate = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+    print(f"Server prefix cache: {hit_rate:.1%} hit rate, {cached_tokens} of {prompt_tokens} prompt tokens served from cache")
+
+def dispatch_in_order(fn, jobs, concurrency):
+    # Yield fn(*job) for every job in submission order.
+    # At most `concurrency` calls are in flight; a few more are queued so workers never idle behind a slow head.
+    if concurrency <= 1:
+        for job in jobs:
+            yield fn(*job)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    window = deque()
+    try:
+        for job in jobs:
+            if len(window) >= concurrency * 4:
+                yield window.popleft().result()
+            window.append(executor.submit(fn, *job))
+        while window:
+            yield window.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def get_parse_pipeline():
+    global parse_pipeline
+    if parse_pipeline is None:
+        # torch and transformers are only needed here; importing them at startup costs seconds and gigabytes of RSS
+        import torch
+        import transformers
+        parse_pipeline = transformers.pipeline(
+            "text-generation",
+            model=PARSE_MODEL,
+            model_kwargs={"torch_dtype": torch.bfloat16},
+            device_map="auto",
+        )
+        # Batched generation with a decoder-only model needs left padding
+        parse_pipeline.tokenizer.padding_side = "left"
+        if parse_pipeline.tokenizer.pad_token_id is None:
+            parse_pipeline.tokenizer.pad_token_id = parse_pipeline.tokenizer.eos_token_id
+    return parse_pipeline
+
+def parse_with_llm(responses):
+    # Run the parse model over `responses` in length-sorted batches, so each padded batch wastes little compute,
+    # and return the extracted letters in the original order
+    pipeline = get_parse_pipeline()
+    by_length = sorted(range(len(responses)), key=lambda i: len(responses[i]))
+    letters = [None] * len(responses)
+    for start in range(0, len(by_length), args.parse_batch_size):
+        batch = by_length[start:start + args.parse_batch_size]
+        chats = [[
+            {"role": "system", "content": PARSE_TEMPLATE},
+            {"role": "user", "content": responses[i]},
+        ] for i in batch]
+        # Only the first character of the reply is used, so a short generation budget is enough
+        outputs = pipeline(chats, batch_size=len(chats), max_new_tokens=16, pad_token_id = pipeline.tokenizer.eos_token_id)
+        for i, output in zip(batch, outputs):
+            letters[i] = output[0]["generated_text"][-1]['content'].strip()[0].upper()
+    return letters
+
+def answer_from_logprobs(response):
+    if not isinstance(response, dict) or "logprobs" not in response:
+        raise Exception(f"Server does not support logprob scoring, got: {response!r}")
+    extractor.resolved["logprob"] += 1
+    return response["choice"]
+
+def constrained_letter(response):
+    # The reply (base) or its last line (CoT) as the server constrained it
+    return response.strip().splitlines()[-1].strip() if response.strip() else ""
+
+def answer_from_constrained(response):
+    letter = constrained_letter(response)
+    if letter not in OPTION_LETTERS:
+        raise Exception(f"Server did not enforce the allowed choices, got: {response!r}")
+    extractor.resolved["constrained"] += 1
+    return letter
+
+def clean_response(response):
+    return response.strip('assistant\n\n').strip()
+
+def extract_answer(response, question):
+    # Clear-cut replies are settled by the rule cascade; returns None when the reply is left for the parse model
+    answer = extractor.resolve(response, parse_options(question), cot=args.cot)
+    if answer is not None:
+        return answer
+    if args.parse_mode:
+        return None
+    extractor.resolved["legacy"] += 1
+    if args.cot:
+        return response.strip('.').strip('\'').strip('\"').strip('*').strip('*')[-1].upper()
+    else:
+        return response.strip('.').strip('\'').strip('\"').strip('*').strip('*')[0].upper()
+
 def get_accuracy(answers, model_answers):
     correct_1 = 0
     correct_2 = 0
@@ -110,90 +395,168 @@ def get_accuracy(answers, model_answers):
     return correct_1 / len(answers), correct_2 / len(answers), correct_3 / len(answers), all_correct / len(answers)
 
 def main():
-    order_list = [[1, 2, 3, 4, 5, 6], [6, 5, 4, 3, 2, 1], [3, 1, 6, 5, 4, 2], [2, 3, 5, 6, 1, 4], [5, 4, 1, 2, 6, 3], [4, 6, 2, 1, 3, 5]]
+    global cache, extractor, retry_policy
+    order_list = ORDER_LIST
 
     if args.cot:
         eval_type = 'cot'
+    elif args.scoring == 'logprob':
+        eval_type = 'base_logprob'
     else:
         eval_type = 'base'
+    if args.constrained:
+        eval_type += '_constrained'
     current_directory = os.getcwd()  # Get current working directory
     input_file_path = os.path.join(current_directory, args.dataset, f"{args.dataset}_questions.json")
     output_file_path = os.path.join(current_directory, "results", f"{args.dataset}_{args.llm.split('/')[-1]}_{eval_type}.log")
     ourdir = os.path.dirname(output_file_path)
+    if args.run_tag is None:
+        args.run_tag = os.path.splitext(os.path.basename(output_file_path))[0]
     os.makedirs(ourdir, exist_ok=True)
 
-    if args.parse_mode:
-        model_id = "Qwen/Qwen2.5-7B-Instruct"
-        pipeline = transformers.pipeline(
-            "text-generation",
-            model=model_id,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device_map="auto",
-        )
-        parse_template = "Extract the letters of the option from the given text and return only ONE letter as the answer. The answer can only return **one character without any other explanation**."
+    extractor = AnswerExtractor(threshold=args.extract_threshold)
+    retry_policy = RetryPolicy(args.max_retries, args.retry_base_delay, args.retry_max_delay,
+                               CircuitBreaker(args.breaker_threshold, args.breaker_cooldown))
+
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024)
+
+    # The plan is compiled once per (dataset, CoT) and reused from disk; items are streamed from it, never held in memory.
+    plan = EvalPlan.load_or_build(input_file_path, args.cot, order_list, os.path.join(current_directory, "results", "plans"))
+
+    # Every response is appended to the journal as soon as it arrives, so an aborted run can be picked up with --resume
+    journal_path = os.path.splitext(output_file_path)[0] + ".journal.jsonl"
+    journal = EvalJournal(journal_path, os.path.basename(plan.path), resume=args.resume, valid=valid_response)
+    if args.resume:
+        print(f"Resuming from {journal_path}: {len(journal)} responses already journaled")
+
+    # With --pretokenize, every prompt is tokenized once per (plan, model) ahead of the run and sent as token ids
+    tokens = plan.load_or_tokenize(args.llm) if args.pretokenize else None
 
+    def iter_token_ids(order_idx=None):
+        if tokens is None:
+            return itertools.repeat(None)
+        return iter(tokens) if order_idx is None else tokens.iter_order(order_idx)
 
+    def iter_jobs():
+        if args.schedule == 'item':
+            # All option permutations of one question stem are sent back to back, so they share the cached prefix
+            for item_idx, (item, item_ids) in enumerate(zip(plan, iter_token_ids())):
+                for question_idx in range(3):
+                    for order_idx in range(len(order_list)):
+                        key = (order_idx, item_idx, question_idx)
+                        if key not in journal:
+                            token_ids = item_ids[order_idx][question_idx] if item_ids is not None else None
+                            yield key, item.prompts[order_idx][question_idx], token_ids, time.perf_counter()
+        else:
+            for order_idx in range(len(order_list)):
+                for item_idx, ((questions, _), question_ids) in enumerate(zip(plan.iter_order(order_idx), iter_token_ids(order_idx))):
+                    for question_idx, question in enumerate(questions):
+                        key = (order_idx, item_idx, question_idx)
+                        if key not in journal:
+                            token_ids = question_ids[question_idx] if question_ids is not None else None
+                            yield key, question, token_ids, time.perf_counter()
+
+    # Per-request timings go to a sidecar next to the log
+    metrics = EvalMetrics(os.path.splitext(output_file_path)[0] + ".metrics.jsonl", resume=args.resume)
+
+    stopped_early = []
+
+    def run_job(key, question, token_ids, submitted):
+        stats = {}
+        started = time.perf_counter()
+        response = get_model_response(question, stats, token_ids)
+        metrics.record(key, submitted, started, time.perf_counter(), **stats)
+        journal.record(key, response)
+        if stats.get("stopped_early"):
+            stopped_early.append(key)
+        return 1
+
+    def iter_batches():
+        batch = []
+        for job in iter_jobs():
+            batch.append(job)
+            if len(batch) == args.batch_requests:
+                yield (batch,)
+                batch = []
+        if batch:
+            yield (batch,)
+
+    def run_batch(batch):
+        submitted = {key: submitted for key, _, _, submitted in batch}
+        started = time.perf_counter()
+
+        def on_response(key, response, stats):
+            metrics.record(key, submitted[key], started, time.perf_counter(), **stats)
+            journal.record(key, response)
+
+        get_model_responses_batch([(key, question, token_ids) for key, question, token_ids, _ in batch], on_response)
+        return len(batch)
+
+    # Jobs of every order are dispatched as one stream so the in-flight window spans order boundaries
+    num_pending = sum(1 for _ in iter_jobs())
+    prefix_stats_before = get_prefix_cache_stats()
+    if args.batch_requests > 0:
+        dispatched = dispatch_in_order(run_batch, iter_batches(), args.concurrency)
+    else:
+        dispatched = dispatch_in_order(run_job, iter_jobs(), args.concurrency)
+    with tqdm(total=num_pending) as progress:
+        for done in dispatched:
+            progress.update(done)
+    report_prefix_cache_stats(prefix_stats_before, get_prefix_cache_stats())
+    metrics.close()
+    metrics.export_chrome_trace(os.path.splitext(output_file_path)[0] + ".trace.json")
+    print(f"Request metrics:\n{metrics.format_summary()}")
+    if retry_policy.breaker.opened:
+        print(f"Circuit breaker opened {retry_policy.breaker.opened} times; workers paused while the server was overloaded")
+    if args.stop_on_answer:
+        print(f"Stopped early: {len(stopped_early)} generations cancelled after their answer line")
+
+    # The log and accuracy numbers are rebuilt from the journal in (order, item, question) position
     f = open(output_file_path, 'w', encoding='utf-8')
+    if args.scoring == 'logprob':
+        # Per-option distributions next to the log, for calibration analysis
+        logprob_file = open(os.path.splitext(output_file_path)[0] + ".logprobs.jsonl", 'w', encoding='utf-8')
     acc_1 = 0
     acc_2 = 0
     acc_3 = 0
     acc_all = 0
 
-    for order in order_list:
-        questions, answers = load_questions(input_file_path, order)
+    for order_idx, order in enumerate(order_list):
+        answers = []
         model_answers = []
 
-        if args.parse_mode:
-            for question in tqdm(questions):
-                question_1, question_2, question_3 = question
-                answer_1 = get_model_response(question_1).strip('assistant\n\n').strip()
-                messages = [
-                    {"role": "system", "content": parse_template},
-                    {"role": "user", "content": answer_1},
-                ]
-
-                answer_1 = pipeline(messages, max_new_tokens=256, pad_token_id = pipeline.tokenizer.eos_token_id)[0]["generated_text"][-1]['content'].strip()[0].upper()
-      
-                answer_2 = get_model_response(question_2).strip('assistant\n\n').strip()
-                messages = [
-                    {"role": "system", "content": parse_template},
-                    {"role": "user", "content": answer_2},
-                ]
-                answer_2 = pipeline(messages, max_new_tokens=256, pad_token_id = pipeline.tokenizer.eos_token_id)[0]["generated_text"][-1]['content'].strip()[0].upper()
-
-                answer_3 = get_model_response(question_3).strip('assistant\n\n').strip()
-                messages = [
-                    {"role": "system", "content": parse_template},
-                    {"role": "user", "content": answer_3},
-                ]
-                answer_3 = pipeline(messages, max_new_tokens=256, pad_token_id = pipeline.tokenizer.eos_token_id)[0]["generated_text"][-1]['content'].strip()[0].upper()
-
-                model_answers.append([answer_1, answer_2, answer_3])
-                print(f"Question 1: {question_1}\nAnswer 1: {answer_1}\n\nQuestion 2: {question_2}\nAnswer 2: {answer_2}\n\nQuestion 3: {question_3}\nAnswer 3: {answer_3}\n\n")
-        else:
-            if args.cot:
-                for question in tqdm(questions):
-                    question_1, question_2, question_3 = question
-                    answer_1 = get_model_response(question_1).strip('assistant\n\n').strip()
-                    answer_1 = answer_1.strip('.').strip('\'').strip('\"').strip('*').strip('*')[-1].upper()
-                    answer_2 = get_model_response(question_2).strip('assistant\n\n').strip()
-                    answer_2 = answer_2.strip('.').strip('\'').strip('\"').strip('*').strip('*')[-1].upper()
-                    answer_3 = get_model_response(question_3).strip('assistant\n\n').strip()
-                    answer_3 = answer_3.strip('.').strip('\'').strip('\"').strip('*').strip('*')[-1].upper()
-                    model_answers.append([answer_1, answer_2, answer_3])
-                    print(f"Question 1: {question_1}\nAnswer 1: {answer_1}\n\nQuestion 2: {question_2}\nAnswer 2: {answer_2}\n\nQuestion 3: {question_3}\nAnswer 3: {answer_3}\n\n")
-            else:
-                for question in tqdm(questions):
-                    question_1, question_2, question_3 = question
-                    answer_1 = get_model_response(question_1).strip('assistant\n\n').strip()
-                    answer_1 = answer_1.strip('.').strip('\'').strip('\"').strip('*').strip('*')[0].upper()
-                    answer_2 = get_model_response(question_2).strip('assistant\n\n').strip()
-                    answer_2 = answer_2.strip('.').strip('\'').strip('\"').strip('*').strip('*')[0].upper()
-                    answer_3 = get_model_response(question_3).strip('assistant\n\n').strip()
-                    answer_3 = answer_3.strip('.').strip('\'').strip('\"').strip('*').strip('*')[0].upper()
-                    model_answers.append([answer_1, answer_2, answer_3])
-                    print(f"Question 1: {question_1}\nAnswer 1: {answer_1}\n\nQuestion 2: {question_2}\nAnswer 2: {answer_2}\n\nQuestion 3: {question_3}\nAnswer 3: {answer_3}\n\n")
+        # Replies the rules cannot settle are collected for the whole order and parsed as one batched stage
+        unresolved = []
+        for item_idx, (question, answer) in enumerate(plan.iter_order(order_idx)):
+            model_answer = []
+            for question_idx in range(3):
+                response = journal.get((order_idx, item_idx, question_idx))
+                if args.scoring == 'logprob':
+                    letter = answer_from_logprobs(response)
+                    logprob_file.write(json.dumps({"order": order_idx, "item": item_idx, "question": question_idx, "gold": answer[question_idx], **response}) + "\n")
+                elif args.constrained:
+                    letter = answer_from_constrained(response)
+                else:
+                    response = clean_response(response)
+                    letter = extract_answer(response, question[question_idx])
+                    if letter is None:
+                        unresolved.append((item_idx, question_idx, response))
+                model_answer.append(letter)
+            answers.append(answer)
+            model_answers.append(model_answer)
+
+        if unresolved:
+            letters = parse_with_llm([response for _, _, response in unresolved])
+            for (item_idx, question_idx, _), letter in zip(unresolved, letters):
+                model_answers[item_idx][question_idx] = letter
+            extractor.resolved["llm"] += len(unresolved)
 
+        for (question, _), (answer_1, answer_2, answer_3) in zip(plan.iter_order(order_idx), model_answers):
+            if args.quiet:
+                break
+            question_1, question_2, question_3 = question
+            print(f"Question 1: {question_1}\nAnswer 1: {answer_1}\n\nQuestion 2: {question_2}\nAnswer 2: {answer_2}\n\nQuestion 3: {question_3}\nAnswer 3: {answer_3}\n\n")
 
         accuracy_1, accuracy_2, accuracy_3, accuracy_all = get_accuracy(answers, model_answers)
         acc_1 += accuracy_1
@@ -217,8 +580,24 @@ def main():
     f.write(f"Average accuracy of question 3: {acc_3 / len(order_list)}\n")
     f.write(f"Average accuracy of all questions: {acc_all / len(order_list)}\n")
     f.write("------------------------------------------------------------\n")
+    f.close()
+    journal.close()
+    if args.scoring == 'logprob':
+        logprob_file.close()
+
+    print(f"Answers resolved per extraction tier:\n{extractor.report()}")
+
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}")
+        cache.close()
 
 if __name__ == "__main__":
     parser = get_parser()
     args = parser.parse_args()
+    if args.scoring == 'logprob' and (args.cot or args.parse_mode or args.constrained):
+        parser.error("--scoring logprob scores the next token directly and cannot be combined with --cot, --parse_mode or --constrained")
+    if args.stream and (args.scoring == 'logprob' or args.batch_requests):
+        parser.error("--stream cannot be combined with --scoring logprob or --batch_requests")
+    if args.stop_on_answer and not args.stream:
+        parser.error("--stop_on_answer requires --stream")
     main()
\ No newline at end of file
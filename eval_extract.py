@@ -0,0 +1,103 @@
+import re
+from collections import Counter
+
+
+LETTERS = "ABCDEF"
+
+# Markdown, quotes and punctuation that models like to wrap a bare answer letter in
+WRAPPER_CHARS = " \t\r\n*_#>`'\"()[].:"
+
+# The letter must be on the same line as the tag: "Let me evaluate each answer:\nA: ..." is not an answer
+ANSWER_TAG_RE = re.compile(
+    r"(?:answer|final\s+choice|correct\s+option|best\s+option)"
+    r"(?:[ \t]+is|[ \t]+would[ \t]+be|[ \t]+should[ \t]+be)?[ \t]*[:：\-]?[ \t]*(?:option[ \t]+)?[*_(\[ \t]*(?-i:([A-F]))(?![A-Za-z])"
+    # "the answer is A person who ..." uses the article, not the letter
+    r"(?!(?<=A)\s+[a-z])",
+    re.IGNORECASE,
+)
+FINAL_LINE_RE = re.compile(r"^[\s*_#>`'\"(\[]*(?:(?:final\s+)?answer\s*[:：]?\s*)?(?-i:([A-F]))[\s*_`'\").\]:]*$", re.IGNORECASE)
+# Only an explicit "Answer: X" line; a bare letter may be an option heading in the middle of the reasoning
+ANSWER_LINE_RE = re.compile(r"^[\s*_#>`'\"(\[]*(?:final\s+)?answer\s*[:：]?[\s*_`'\"(\[]*(?-i:([A-F]))[\s*_`'\").\]:]*$", re.IGNORECASE)
+LEADING_LETTER_RE = re.compile(r"^[\s*_`'\"(\[]*([A-F])(?:[.:)\]]|\*\*|\s*$)")
+BOLD_RE = re.compile(r"\*\*\s*\(?([A-F])\)?[.:]?\s*\*\*")
+
+
+def is_answer_line(line):
+    # A complete line that holds nothing but an explicit final answer, e.g. "Answer: B" or "**Final answer: B**"
+    return ANSWER_LINE_RE.match(line) is not None
+
+
+class AnswerExtractor:
+    """Cascade of rule-based answer extractors, from the most to the least certain.
+
+    `extract` returns (letter, confidence, tier); callers fall back to a heavier parser when the confidence
+    is below the threshold. `resolved` counts which tier (or fallback) settled each reply.
+    """
+
+    TIERS = ["exact", "answer_tag", "final_line", "leading_letter", "bold", "option_text"]
+
+    def __init__(self, threshold=0.75):
+        self.threshold = threshold
+        self.resolved = Counter()
+
+    def extract(self, response, options=None, cot=False):
+        text = response.strip()
+        if not text:
+            return None, 0.0, None
+
+        # Tier 1: the whole reply is a single letter
+        bare = text.strip(WRAPPER_CHARS)
+        if len(bare) == 1 and bare.upper() in LETTERS:
+            return bare.upper(), 1.0, "exact"
+
+        # Tier 3: the last non-empty line holds nothing but a letter. The CoT prompt asks for the answer there, so
+        # for CoT replies it outranks any "Answer: X" in the reasoning above it
+        lines = [line for line in text.splitlines() if line.strip()]
+        final_line = FINAL_LINE_RE.match(lines[-1])
+        if cot and final_line:
+            return final_line.group(1), 0.9, "final_line"
+
+        # Tier 2: an explicit "Answer: X" / "the answer is X", the last one wins
+        tags = ANSWER_TAG_RE.findall(text)
+        if tags:
+            return tags[-1], 0.95 if len(set(tags)) == 1 else 0.6, "answer_tag"
+
+        if final_line:
+            return final_line.group(1), 0.9, "final_line"
+
+        # Tier 4: a direct answer that starts with the letter, e.g. "B. To address ..."; CoT replies often
+        # open by walking through the options, so this is only trusted for base answers
+        if not cot:
+            match = LEADING_LETTER_RE.match(text)
+            if match:
+                return match.group(1), 0.85, "leading_letter"
+
+        # Tier 5: bolded letters, trusted only if they all agree
+        bolds = BOLD_RE.findall(text)
+        if bolds:
+            return bolds[-1], 0.8 if len(set(bolds)) == 1 else 0.4, "bold"
+
+        # Tier 6: exactly one option text is quoted in the reply
+        if options:
+            lowered = text.lower()
+            hits = [option[0] for option in options if option.split('. ', 1)[1].strip().lower() in lowered]
+            if len(hits) == 1:
+                return hits[0], 0.75, "option_text"
+
+        return None, 0.0, None
+
+    def resolve(self, response, options=None, cot=False):
+        # Returns the letter if a rule tier is confident enough, otherwise None, and books the tier that resolved it
+        letter, confidence, tier = self.extract(response, options, cot)
+        if letter is not None and confidence >= self.threshold:
+            self.resolved[tier] += 1
+            return letter
+        return None
+
+    def report(self):
+        total = sum(self.resolved.values())
+        lines = []
+        for tier in self.TIERS + sorted(set(self.resolved) - set(self.TIERS)):
+            if self.resolved[tier]:
+                lines.append(f"  {tier}: {self.resolved[tier]} ({self.resolved[tier] / total:.1%})")
+        return "\n".join(lines)
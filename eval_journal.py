@@ -0,0 +1,72 @@
+import json
+import os
+import threading
+
+
+class EvalJournal:
+    """Append-only JSONL journal of raw model responses, one line per (order, item, question).
+
+    Only byte offsets are kept in memory; responses are read back from disk when the results are rebuilt. On resume,
+    responses that `valid` rejects are not counted as answered, so their questions are asked again.
+    """
+
+    def __init__(self, path, plan_id, resume=False, valid=None):
+        self.path = path
+        self.plan_id = plan_id
+        self.valid = valid
+        self._offsets = {}
+        self._lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            self._load()
+        else:
+            with open(path, 'wb') as f:
+                f.write((json.dumps({"plan": plan_id}) + "\n").encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+
+        self._writer = open(path, 'ab')
+        self._reader = open(path, 'rb')
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            header = json.loads(f.readline())
+            if header.get("plan") != self.plan_id:
+                raise ValueError(f"Journal {self.path} was written for plan {header.get('plan')}, not {self.plan_id}; rerun without --resume")
+            offset = f.tell()
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash in the middle of a write leaves at most one torn line at the end
+                    break
+                if self.valid is None or self.valid(record["response"]):
+                    self._offsets[(record["order"], record["item"], record["question"])] = offset
+                offset += len(line)
+        # Cut off a torn tail so new records start on a fresh line
+        os.truncate(self.path, offset)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def record(self, key, response):
+        order, item, question = key
+        line = (json.dumps({"order": order, "item": item, "question": question, "response": response}, ensure_ascii=False) + "\n").encode('utf-8')
+        with self._lock:
+            offset = self._writer.tell()
+            self._writer.write(line)
+            self._writer.flush()
+            self._offsets[key] = offset
+        return response
+
+    def get(self, key):
+        with self._lock:
+            self._reader.seek(self._offsets[key])
+            return json.loads(self._reader.readline())["response"]
+
+    def close(self):
+        self._writer.close()
+        self._reader.close()
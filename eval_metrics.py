@@ -0,0 +1,140 @@
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+
+
+TASK_NAMES = ["motivation", "behavior", "motivation_behavior"]
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+    rank = max(math.ceil(q * len(values) / 100) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class EvalMetrics:
+    """Per-request timing and token metrics of an evaluation run.
+
+    Every call is appended to a JSONL sidecar as it completes; a compact copy is kept in memory for the
+    end-of-run summary and the Chrome trace. With `resume`, the sidecar of the interrupted run is appended to;
+    the summary and trace cover only the calls of this run.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._records = []
+        self._origin = time.perf_counter()
+        self._origin_wall = time.time()
+
+    def record(self, key, submitted, started, finished, ttfb=None, prompt_tokens=None, completion_tokens=None, retries=0, cached=False,
+               ttft=None, stopped_early=False):
+        order, item, question = key
+        record = {
+            "order": order,
+            "item": item,
+            "question": question,
+            "task": TASK_NAMES[question],
+            "start": self._origin_wall + (started - self._origin),
+            "queue_wait": started - submitted,
+            "ttfb": ttfb,
+            # Streamed requests only: arrival of the first content token, and whether generation was cancelled after the answer
+            "ttft": ttft,
+            "stopped_early": stopped_early,
+            "latency": finished - started,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "retries": retries,
+            "cached": cached,
+        }
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            # Flushed like the journal, so a killed run keeps the timings of every journaled response
+            self._file.flush()
+            self._records.append((order, question, started - self._origin, finished - self._origin, prompt_tokens, completion_tokens, cached, threading.get_ident(), ttft,
+                                  retries))
+
+    def _group_summary(self, records):
+        model_calls = [r for r in records if not r[6]]
+        latencies = sorted(r[3] - r[2] for r in model_calls)
+        ttfts = sorted(r[8] for r in model_calls if r[8] is not None)
+        summary = {"requests": len(records), "cached": len(records) - len(model_calls), "retries": sum(r[9] for r in records)}
+        if not model_calls:
+            return summary
+        span = max(r[3] for r in model_calls) - min(r[2] for r in model_calls)
+        completion_tokens = sum(r[5] for r in model_calls if r[5] is not None)
+        prompt_tokens = sum(r[4] for r in model_calls if r[4] is not None)
+        summary.update({
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "ttft_p50": percentile(ttfts, 50),
+            "ttft_p95": percentile(ttfts, 95),
+            "requests_per_s": len(model_calls) / span if span > 0 else None,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            # Servers that do not report usage leave the token counts empty
+            "tokens_per_s": completion_tokens / span if span > 0 and completion_tokens else None,
+        })
+        return summary
+
+    def summary(self):
+        by_task = defaultdict(list)
+        by_order = defaultdict(list)
+        for record in self._records:
+            by_order[record[0]].append(record)
+            by_task[TASK_NAMES[record[1]]].append(record)
+        return {
+            "overall": self._group_summary(self._records),
+            "by_task": {task: self._group_summary(records) for task, records in by_task.items()},
+            "by_order": {order: self._group_summary(records) for order, records in sorted(by_order.items())},
+        }
+
+    def format_summary(self):
+        def fmt(value, unit=""):
+            return "n/a" if value is None else f"{value:.3f}{unit}"
+
+        lines = []
+        summary = self.summary()
+        groups = [("all", summary["overall"])]
+        groups += [(f"task {task}", group) for task, group in summary["by_task"].items()]
+        groups += [(f"order {order}", group) for order, group in summary["by_order"].items()]
+        for name, group in groups:
+            line = (
+                f"  {name}: {group['requests']} requests ({group['cached']} cached), "
+                f"latency p50 {fmt(group.get('p50'), 's')} p95 {fmt(group.get('p95'), 's')} p99 {fmt(group.get('p99'), 's')}, "
+                f"{fmt(group.get('requests_per_s'))} req/s, {fmt(group.get('tokens_per_s'))} tok/s"
+            )
+            if group.get('ttft_p50') is not None:
+                line += f", ttft p50 {fmt(group['ttft_p50'], 's')} p95 {fmt(group['ttft_p95'], 's')}"
+            if group['retries']:
+                line += f", {group['retries']} retries"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        # One complete ("X") event per model call on the thread that issued it; open in chrome://tracing or Perfetto
+        events = []
+        for order, question, start, end, prompt_tokens, completion_tokens, cached, thread_id, _, _ in self._records:
+            events.append({
+                "name": f"order {order} / {TASK_NAMES[question]}",
+                "cat": "cache" if cached else "request",
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": 1,
+                "tid": thread_id,
+                "args": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+            })
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
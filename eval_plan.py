@@ -0,0 +1,172 @@
+import ast
+import hashlib
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+
+PLAN_VERSION = 1
+
+# The six option orders every question is evaluated under
+ORDER_LIST = [[1, 2, 3, 4, 5, 6], [6, 5, 4, 3, 2, 1], [3, 1, 6, 5, 4, 2], [2, 3, 5, 6, 1, 4], [5, 4, 1, 2, 6, 3], [4, 6, 2, 1, 3, 5]]
+
+# (task name used in the instruction, question field, options field, correct answer field)
+QUESTION_FIELDS = [
+    ("Motivational Reasoning Question", "Motivation Reasoning Question", "Options 1", "Correct Answer 1"),
+    ("Behavioral Reasoning Question", "Behavior Reasoning Question", "Options 2", "Correct Answer 2"),
+    ("Motivational and Behavioral Reasoning Question", "Motivation and Behavior Reasoning Question", "Options 3", "Correct Answer 3"),
+]
+
+PROMPT_HEADER = "The following is a {}. Based on the content of the given question, please infer the most likely answer and output the answer index.\n\n"
+COT_SUFFIX = "\n\nPlease first think step by step, conduct analysis on the answers to the questions, output the reasoning process, and finally output the most likely option letter. **The last line of your reply should only contain one character of your final choice.**"
+BASE_SUFFIX = "\n\nPlease answer this multiple-choice question. The result can only return **one character without any other explanation**."
+SYSTEM_PROMPT = "You ara a helpful AI assistant."
+
+# One compiled item: prompts[order_idx] is the [question_1, question_2, question_3] prompt list for that option order,
+# answers[order_idx] is the matching string of three remapped gold letters.
+PlanItem = namedtuple("PlanItem", ["prompts", "answers"])
+
+
+def rearrange_options(options, order):
+    # List of alphabet letters to update the labels
+    labels = ['A', 'B', 'C', 'D', 'E', 'F']
+    # Rearranging the options based on the given order
+    rearranged_options = [options[i-1] for i in order]
+    # Updating the labels
+    updated_options = [f"{labels[i]}. {option.split('. ', 1)[1]}" for i, option in enumerate(rearranged_options)]
+    return updated_options
+
+def get_new_correct_answer(original_correct, order):
+    # Get the original index of the correct answer (A=0, B=1, etc.)
+    original_index = ord(original_correct) - ord('A')
+    # Find the new index of the correct answer based on the rearranged order
+    new_index = order.index(original_index + 1)
+    # Return the new correct letter
+    return chr(new_index + ord('A'))
+
+def build_prompt(task, question, options, cot):
+    suffix = COT_SUFFIX if cot else BASE_SUFFIX
+    return PROMPT_HEADER.format(task) + question + "\nOptions: " + str(options) + suffix
+
+def parse_options(prompt):
+    # Recover the rearranged option list from a compiled prompt, where it is embedded as "\nOptions: [...]"
+    start = prompt.rindex("\nOptions: ") + len("\nOptions: ")
+    end = prompt.rindex("]", start) + 1
+    return ast.literal_eval(prompt[start:end])
+
+def chat_messages(prompt):
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def compile_item(item, cot, order_list):
+    prompts = []
+    answers = []
+    for order in order_list:
+        prompts.append([build_prompt(task, item[question_field], rearrange_options(item[options_field], order), cot)
+                        for task, question_field, options_field, _ in QUESTION_FIELDS])
+        answers.append("".join(get_new_correct_answer(item[answer_field], order) for _, _, _, answer_field in QUESTION_FIELDS))
+    return PlanItem(prompts, answers)
+
+# Tokenizer of a tokenization worker process, loaded once per worker
+_tokenizer = None
+
+def _load_tokenizer(model):
+    global _tokenizer
+    from transformers import AutoTokenizer
+    _tokenizer = AutoTokenizer.from_pretrained(model, trust_remote_code=True)
+
+def _tokenize_item(line):
+    # Rendered and tokenized exactly like server_vllm.py does it for a text prompt
+    prompts = json.loads(line)[0]
+    return json.dumps([[_tokenizer.encode(_tokenizer.apply_chat_template(chat_messages(prompt), tokenize=False, add_generation_prompt=True))
+                        for prompt in questions] for questions in prompts])
+
+
+class EvalPlan:
+    """Compiled evaluation plan stored as JSONL, one item per line, read back lazily."""
+
+    def __init__(self, path, order_list, num_items):
+        self.path = path
+        self.order_list = order_list
+        self.num_items = num_items
+
+    def __len__(self):
+        return self.num_items
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            next(f)  # header
+            for line in f:
+                yield PlanItem(*json.loads(line))
+
+    def iter_order(self, order_idx):
+        # Yields ([question_1, question_2, question_3], answers) for every item under one option order
+        for item in self:
+            yield item.prompts[order_idx], item.answers[order_idx]
+
+    def load_or_tokenize(self, model, workers=None):
+        # Token ids of every prompt under `model`'s chat template, stored next to the plan one line per item.
+        # Tokenization runs once per (plan, model) in a process pool, off the request path.
+        path = f"{os.path.splitext(self.path)[0]}.{model.replace('/', '--')}.tokens.jsonl"
+        if not os.path.exists(path):
+            tmp_path = path + ".tmp"
+            with open(self.path, 'r', encoding='utf-8') as f, open(tmp_path, 'w', encoding='utf-8') as out, \
+                    ProcessPoolExecutor(max_workers=workers, initializer=_load_tokenizer, initargs=(model,)) as executor:
+                next(f)  # header
+                for line in executor.map(_tokenize_item, f, chunksize=8):
+                    out.write(line + "\n")
+            os.replace(tmp_path, path)
+        return PlanTokens(path)
+
+    @staticmethod
+    def plan_key(input_file, cot, order_list):
+        digest = hashlib.sha256()
+        with open(input_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(json.dumps([PLAN_VERSION, cot, order_list, PROMPT_HEADER, COT_SUFFIX, BASE_SUFFIX]).encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+    @classmethod
+    def load_or_build(cls, input_file, cot, order_list, plan_dir):
+        dataset = os.path.splitext(os.path.basename(input_file))[0]
+        eval_type = 'cot' if cot else 'base'
+        path = os.path.join(plan_dir, f"{dataset}_{eval_type}_{cls.plan_key(input_file, cot, order_list)}.jsonl")
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                header = json.loads(next(f))
+            return cls(path, header["order_list"], header["num_items"])
+
+        with open(input_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        # Write to a temporary file first so an interrupted build never leaves a truncated plan behind
+        os.makedirs(plan_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"version": PLAN_VERSION, "order_list": order_list, "num_items": len(data)}) + "\n")
+            for item in data:
+                f.write(json.dumps(compile_item(item, cot, order_list), ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+        return cls(path, order_list, len(data))
+
+
+class PlanTokens:
+    """Pre-tokenized prompts of an EvalPlan, aligned with it item by item and read back lazily."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def iter_order(self, order_idx):
+        # Yields [ids_1, ids_2, ids_3] for every item under one option order
+        for item in self:
+            yield item[order_idx]
@@ -0,0 +1,111 @@
+import random
+import threading
+import time
+
+import requests
+
+
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+def retry_after_seconds(response):
+    # Only the delay-seconds form of Retry-After is used; an HTTP date falls back to plain backoff
+    value = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+class CircuitBreaker:
+    """Pauses every worker while the server is overloaded.
+
+    After `threshold` consecutive failed attempts (across all threads) the breaker opens: requests wait instead of
+    being sent. After `cooldown` seconds one probe request is let through; its success closes the breaker, its
+    failure reopens it for another cooldown.
+    """
+
+    def __init__(self, threshold=10, cooldown=5.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.opened = 0
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+
+    def wait(self):
+        while True:
+            with self._lock:
+                if self._failures < self.threshold:
+                    return
+                now = time.monotonic()
+                if now >= self._open_until and not self._probing:
+                    self._probing = True
+                    return
+                delay = max(self._open_until - now, 0.05)
+            time.sleep(delay)
+
+    def record(self, ok):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= self.threshold:
+                now = time.monotonic()
+                if now >= self._open_until:
+                    self.opened += 1
+                self._open_until = now + self.cooldown
+
+
+class RetryPolicy:
+    """Retries overload responses (429/502/503/504) and connection errors with capped, fully jittered exponential
+    backoff. A Retry-After header sets the minimum delay. Other responses are returned as they are."""
+
+    def __init__(self, max_retries=8, base_delay=1.0, max_delay=60.0, breaker=None, seed=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+        self._rng = random.Random(seed)
+
+    def delay(self, attempt, retry_after=None):
+        delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        # Spread the retries above the server's hint instead of sending them all back at the same instant
+        return delay + retry_after if retry_after is not None else delay
+
+    def call(self, send, on_retry=None):
+        # send() performs one attempt and returns a requests.Response; on_retry() is called before every retry
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                self.breaker.wait()
+            error = None
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, error = None, e
+            except BaseException:
+                # Anything else (e.g. ChunkedEncodingError) fails the request, but must still be recorded, or a
+                # failed probe would leave every other worker waiting on the breaker forever
+                if self.breaker is not None:
+                    self.breaker.record(False)
+                raise
+            retryable = response is None or response.status_code in RETRY_STATUS
+            if self.breaker is not None:
+                self.breaker.record(not retryable)
+            if not retryable:
+                return response
+            if attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return response
+            delay = self.delay(attempt, retry_after_seconds(response))
+            if response is not None:
+                response.close()
+            if on_retry is not None:
+                on_retry()
+            time.sleep(delay)
+            attempt += 1
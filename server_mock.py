@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import time
+import uuid
+
+import requests
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+
+from serving_admission import AdmissionController, add_admission_args, admission_from_args
+from serving_batch import run_batch
+from serving_batcher import MicroBatcher
+from serving_ratelimit import TokenBucket
+from serving_stream import sse_response
+
+# Stand-in for server_vllm.py / server_openai.py that needs neither a GPU nor Azure credentials.
+# It replays recorded transcripts, proxies to a real server while recording, or synthesizes answers
+# with configurable latency, so client_eval.py and the generation scripts can be benchmarked on a CPU box.
+
+app = FastAPI()
+
+args = None
+transcripts = {}  # request key -> recorded response
+record_file = None
+slots = None  # Simulated serving capacity, an asyncio.Semaphore
+batcher = None  # Set with --max-batch-size > 1 to simulate a backend that only runs whole batches
+admission = AdmissionController()  # Set with --concurrency-limit to exercise client backoff against 429/503
+quota_buckets = []  # (TokenBucket, cost of a request) of the simulated Azure RPM/TPM quotas
+timing_rng = random.Random(0)
+
+LETTERS = ['A', 'B', 'C', 'D', 'E', 'F']
+
+
+def request_key(json_post_raw):
+    # Transcripts are matched on everything but transport details; pre-tokenized prompts duplicate the messages
+    payload = {k: v for k, v in json_post_raw.items() if k not in ("stream", "prompt_token_ids")}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def load_transcripts(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                transcripts[request_key(record["request"])] = record["response"]
+
+def count_tokens(text):
+    # Rough whitespace count; good enough to drive the simulated token rate
+    return max(len(text.split()), 1)
+
+def synthesize(json_post_raw):
+    # Deterministic per request, so repeated runs produce identical answers
+    key = request_key(json_post_raw)
+    rng = random.Random(key)
+    letter = rng.choice(LETTERS)
+
+    if json_post_raw.get('logprob_choices'):
+        choices = json_post_raw['logprob_choices']
+        weights = [rng.random() for _ in choices]
+        norm = sum(weights)
+        logprobs = {choice: math.log(weight / norm) for choice, weight in zip(choices, weights)}
+        return {"choice": max(logprobs, key=logprobs.get), "logprobs": logprobs}
+
+    if json_post_raw.get('allowed_choices') and not json_post_raw.get('reasoning'):
+        return rng.choice(json_post_raw['allowed_choices'])
+
+    prompt = json_post_raw.get('messages', [{}])[-1].get('content', '')
+    if "step by step" in prompt or json_post_raw.get('reasoning'):
+        max_tokens = json_post_raw.get('max_tokens') or args.completion_tokens
+        num_tokens = min(max(int(rng.gauss(args.completion_tokens, args.completion_tokens / 4)), 1), max_tokens)
+        reasoning = " ".join(rng.choice(["the", "character", "motivation", "behavior", "scenario", "option", "likely", "because"]) for _ in range(num_tokens))
+        return f"{reasoning}\n{letter}"
+    return letter
+
+def simulated_timing(json_post_raw, response):
+    # Prefill time scales with prompt length, decode time with completion length, both with log-normal jitter.
+    # Returns (time to first token, seconds per completion token).
+    prompt_tokens = sum(count_tokens(m.get('content', '')) for m in json_post_raw.get('messages', []))
+    jitter = timing_rng.lognormvariate(0, args.jitter) if args.jitter > 0 else 1.0
+    ttft = args.ttft_ms / 1000 + prompt_tokens / args.prefill_tokens_per_s
+    return ttft * jitter, jitter / args.tokens_per_s
+
+def simulated_latency(json_post_raw, response):
+    ttft, per_token = simulated_timing(json_post_raw, response)
+    return ttft + count_tokens(response if isinstance(response, str) else json.dumps(response)) * per_token
+
+async def synthesize_batch(batch, params):
+    # A batch runs in lockstep, so it takes as long as its slowest member
+    responses = [synthesize(json_post_raw) for json_post_raw in batch]
+    await asyncio.sleep(max(simulated_latency(json_post_raw, response) for json_post_raw, response in zip(batch, responses)))
+    return responses
+
+def sampling_params_of(json_post_raw):
+    return {k: v for k, v in json_post_raw.items() if k not in ("messages", "stream", "prompt_token_ids")}
+
+async def respond(json_post_raw):
+    key = request_key(json_post_raw)
+    if key in transcripts:
+        response = transcripts[key]
+    elif args.upstream:
+        upstream = await asyncio.to_thread(requests.post, args.upstream, json=json_post_raw)
+        if upstream.status_code != 200:
+            raise HTTPException(status_code=upstream.status_code, detail=upstream.text)
+        response = upstream.json()
+        transcripts[key] = response
+        if record_file is not None:
+            record_file.write(json.dumps({"request": json_post_raw, "response": response}, ensure_ascii=False) + "\n")
+            record_file.flush()
+        return response
+    elif args.strict:
+        raise HTTPException(status_code=404, detail="No recorded transcript for this request")
+    elif batcher is not None:
+        return await batcher.submit(json_post_raw, sampling_params_of(json_post_raw))
+    else:
+        response = synthesize(json_post_raw)
+
+    async with slots:
+        await asyncio.sleep(simulated_latency(json_post_raw, response))
+    return response
+
+async def stream_respond(json_post_raw):
+    # Synthesized replies are paced word by word at the simulated decode rate and hold their slot only while
+    # streaming, so a client that cancels early frees capacity; anything else is sent as one delta
+    key = request_key(json_post_raw)
+    if key in transcripts or args.upstream or args.strict or batcher is not None:
+        yield await respond(json_post_raw)
+        return
+    response = synthesize(json_post_raw)
+    ttft, per_token = simulated_timing(json_post_raw, response)
+    async with slots:
+        await asyncio.sleep(ttft)
+        for word in re.findall(r"\S+\s*|\s+", response):
+            await asyncio.sleep(per_token)
+            yield word
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    json_post_raw = await request.json()
+    release = await admission.acquire("chat_completions")
+    if json_post_raw.get('stream') and not json_post_raw.get('logprob_choices'):
+        return sse_response(stream_respond(json_post_raw), model="mock", on_close=release)
+    try:
+        return await respond(json_post_raw)
+    finally:
+        release()
+
+@app.post("/v1/chat/completions/batch")
+async def chat_completions_batch(request: Request):
+    json_post_raw = await request.json()
+    release = await admission.acquire("batch")
+    return await run_batch(json_post_raw.get('requests', []), respond, json_post_raw.get('stream', False), on_close=release)
+
+@app.post("/chat/")
+async def chat(request: Request):
+    # Contract of the chat server used by agents_generate.py and mi.py
+    json_post_raw = await request.json()
+    release = await admission.acquire("chat")
+    try:
+        response = await respond(json_post_raw)
+    finally:
+        release()
+    return {"response_message": response}
+
+def openai_usage(json_post_raw, response):
+    prompt_tokens = sum(count_tokens(m.get('content', '')) for m in json_post_raw.get('messages', []))
+    completion_tokens = count_tokens(response) if response else 0
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+async def counted(deltas, json_post_raw, usage):
+    # Fills in `usage` as the deltas go by, for the final usage chunk of a stream
+    parts = []
+    async for delta in deltas:
+        parts.append(delta)
+        usage.update(openai_usage(json_post_raw, "".join(parts)))
+        yield delta
+
+def check_quota(json_post_raw):
+    # Like Azure, a request is charged its prompt tokens plus max_tokens when it arrives, and rejected with 429 and
+    # the time until the quota allows it when that would exceed a quota
+    costs = [cost(json_post_raw) for _, cost in quota_buckets]
+    waits = [bucket.wait_time(amount) for (bucket, _), amount in zip(quota_buckets, costs)]
+    if any(wait > 0 for wait in waits):
+        raise HTTPException(status_code=429, detail="Rate limit exceeded", headers={"Retry-After": str(math.ceil(max(waits)))})
+    for (bucket, _), amount in zip(quota_buckets, costs):
+        bucket.take(amount)
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def azure_chat_completions(deployment: str, request: Request):
+    # Azure OpenAI's contract, so server_openai.py can be run against the mock (--azure-endpoint, --api-key)
+    json_post_raw = await request.json()
+    check_quota(json_post_raw)
+    release = await admission.acquire("chat_completions")
+    if json_post_raw.get('stream'):
+        usage = openai_usage(json_post_raw, "")
+        return sse_response(counted(stream_respond(json_post_raw), json_post_raw, usage), model=deployment, on_close=release,
+                            usage=usage if (json_post_raw.get('stream_options') or {}).get('include_usage') else None)
+    try:
+        response = await respond(json_post_raw)
+    finally:
+        release()
+    response = response if isinstance(response, str) else json.dumps(response)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": deployment,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": response}, "finish_reason": "stop"}],
+        "usage": openai_usage(json_post_raw, response),
+    }
+
+@app.get("/v1/batcher_stats")
+async def batcher_stats():
+    return batcher.stats() if batcher is not None else {}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mock LLM server that replays transcripts or synthesizes answers")
+    parser.add_argument('--port', type=int, default=4000, help="Port to run the server on")
+    parser.add_argument('--replay', help="JSONL transcripts ({'request': ..., 'response': ...}) to answer from")
+    parser.add_argument('--record', help="Append every upstream exchange to this JSONL file (requires --upstream)")
+    parser.add_argument('--upstream', help="Forward requests without a transcript to this URL, e.g. http://localhost:3000/v1/chat/completions")
+    parser.add_argument('--strict', action='store_true', help="Return 404 for requests without a transcript instead of synthesizing an answer")
+    parser.add_argument('--slots', type=int, default=64, help="Number of requests served concurrently (default: 64)")
+    parser.add_argument('--ttft-ms', type=float, default=50.0, help="Fixed time to first token in milliseconds (default: 50)")
+    parser.add_argument('--prefill-tokens-per-s', type=float, default=20000.0, help="Simulated prefill rate (default: 20000)")
+    parser.add_argument('--tokens-per-s', type=float, default=50.0, help="Simulated decode rate per request (default: 50)")
+    parser.add_argument('--jitter', type=float, default=0.2, help="Sigma of the log-normal latency multiplier, 0 disables jitter (default: 0.2)")
+    parser.add_argument('--completion-tokens', type=int, default=300, help="Mean length of synthesized CoT replies in tokens (default: 300)")
+    parser.add_argument('--max-batch-size', type=int, default=1, help="Above 1, synthesized requests are micro-batched and each batch takes as long as its slowest member (default: 1)")
+    parser.add_argument('--batch-window-ms', type=float, default=10.0, help="How long the micro-batcher waits for a batch to fill (default: 10)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the latency jitter")
+    add_admission_args(parser, ["chat_completions", "batch", "chat"])
+    parser.add_argument('--quota-rpm', type=int, default=0, help="Requests-per-minute quota of the Azure route, enforced with 429s (default: 0, unlimited)")
+    parser.add_argument('--quota-tpm', type=int, default=0, help="Tokens-per-minute quota of the Azure route, charging prompt tokens plus max_tokens (default: 0, unlimited)")
+    parser.add_argument('--quota-window', type=float, default=10.0, help="Seconds of quota that may be spent in one burst (default: 10)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.record and not args.upstream:
+        raise SystemExit("--record requires --upstream")
+
+    timing_rng.seed(args.seed)
+    slots = asyncio.Semaphore(args.slots)
+    admission = admission_from_args(args)
+    if args.quota_rpm:
+        quota_buckets.append((TokenBucket(args.quota_rpm, args.quota_rpm * args.quota_window / 60), lambda json_post_raw: 1))
+    if args.quota_tpm:
+        quota_buckets.append((TokenBucket(args.quota_tpm, args.quota_tpm * args.quota_window / 60),
+                              lambda json_post_raw: openai_usage(json_post_raw, "")["prompt_tokens"] + (json_post_raw.get('max_tokens') or 0)))
+    if args.max_batch_size > 1:
+        batcher = MicroBatcher(synthesize_batch, max_batch_size=args.max_batch_size, window_ms=args.batch_window_ms)
+    if args.replay:
+        load_transcripts(args.replay)
+        print(f"Loaded {len(transcripts)} transcripts from {args.replay}")
+    if args.record:
+        if os.path.exists(args.record):
+            load_transcripts(args.record)
+        record_file = open(args.record, 'a', encoding='utf-8')
+
+    uvicorn.run(app, host='0.0.0.0', port=args.port, workers=1)
@@ -1,105 +1,303 @@
 import os
-import json
 import argparse
-from typing import Literal
+import asyncio
+import atexit
+import contextlib
+import random
+import time
+from typing import Literal, Optional
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from azure.identity import get_bearer_token_provider, AzureCliCredential
-from openai import AzureOpenAI
+from azure.identity.aio import get_bearer_token_provider, AzureCliCredential
+import openai
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+import httpx
 
-# Create FastAPI application
-app = FastAPI()
+from serving_admission import add_admission_args, admission_from_args
+from serving_batch import run_batch
+from serving_cost import CostLedger
+from serving_log import add_request_log_args, request_log_from_args
+from serving_metrics import ServingMetrics
+from serving_ratelimit import add_rate_limit_args, rate_limiter_from_args
+from serving_stream import sse_response
 
-# Azure OpenAI client configuration
-credential = AzureCliCredential()
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    # uvicorn re-raises SIGTERM/SIGINT after a graceful shutdown, so atexit handlers do not run then
+    cost_ledger.close()
+    request_log.close()
+    await aoiclient.close()
 
-token_provider = get_bearer_token_provider(
-    credential,
-    ""
-)
+# Create FastAPI application
+app = FastAPI(lifespan=lifespan)
 
-aoiclient = AzureOpenAI(
-    azure_endpoint="",  # Set the endpoint for Azure OpenAI service
-    azure_ad_token_provider=token_provider,  # Use credentials to obtain a token
-    api_version="",  # API version
-    max_retries=5,  # Maximum number of retries
-)
+# Define cost information for each model: (input, output) cost per 1000 tokens
+COST_MAP = {
+    "GPT-4-Turbo": (0.01, 0.03),
+    "GPT-4o": (0.005, 0.015),
+    "GPT-35-Turbo": (0.001, 0.002),
+    "GPT-4o-mini": (0.00015, 0.0006),
+    "o1-preview": (0.015, 0.06),
+}
 
 # Define command-line argument parser
 parser = argparse.ArgumentParser(description="FastAPI server with Azure OpenAI support.")
 parser.add_argument("--model", required=True, help="Specify the model name to use, e.g., GPT-4o-mini.")
 parser.add_argument("--port", type=int, default=3000, help="Specify the port for the FastAPI server (default: 3000).")
+parser.add_argument("--azure-endpoint", default="", help="Endpoint of the Azure OpenAI resource, e.g. https://<resource>.openai.azure.com")
+parser.add_argument("--api-version", default="", help="Azure OpenAI API version")
+parser.add_argument("--api-key", default=None, help="Authenticate with an API key instead of the Azure CLI login, e.g. against server_mock.py")
+parser.add_argument("--cost-file", default="cost.json", help="JSON file of the accumulated cost per model and run tag (default: cost.json)")
+parser.add_argument("--cost-flush-interval", type=float, default=5.0, help="Seconds between writes of the cost file; it is also written at shutdown (default: 5)")
+parser.add_argument("--upstream-concurrency", type=int, default=64, help="Upstream calls in flight at once, which also sizes the connection pool (default: 64)")
+add_request_log_args(parser, os.path.join("logs", "server_openai.jsonl"))
+add_admission_args(parser, ["chat_completions", "batch"])
+add_rate_limit_args(parser)
+parser.add_argument("--upstream-retries", type=int, default=5, help="Retries of an upstream call that was throttled (429) or failed transiently (default: 5)")
 args = parser.parse_args()
 model_name = args.model  # Retrieve model name from command-line argument
 port = args.port  # Retrieve port number from command-line argument
 
+# Check if the model name is valid
+if model_name not in COST_MAP:
+    parser.error(f"Undefined model name {model_name!r}; known models: {', '.join(COST_MAP)}")
+
+# Azure OpenAI client configuration. The async client lets one event loop keep many upstream calls in flight over a
+# shared keep-alive connection pool; `upstream_slots` caps how many are outstanding at once.
+token_provider = None
+if args.api_key is None:
+    credential = AzureCliCredential()
+
+    token_provider = get_bearer_token_provider(
+        credential,
+        ""
+    )
+
+aoiclient = AsyncAzureOpenAI(
+    azure_endpoint=args.azure_endpoint,  # Set the endpoint for Azure OpenAI service
+    api_key=args.api_key,  # Only for endpoints without Azure AD, e.g. a local stand-in
+    azure_ad_token_provider=token_provider,  # Use credentials to obtain a token
+    api_version=args.api_version,  # API version
+    max_retries=0,  # Retries are paced by the rate limiter in send_upstream instead
+    http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=args.upstream_concurrency,
+                                                            max_keepalive_connections=args.upstream_concurrency)),
+)
+upstream_slots = asyncio.Semaphore(args.upstream_concurrency)
+
+# Paces upstream calls under the deployment's RPM/TPM quotas (--rpm, --tpm)
+rate_limiter = rate_limiter_from_args(args)
+
+# Served on /metrics in the Prometheus text format
+metrics = ServingMetrics("motivebench")
+metrics.describe("upstream_requests_total", "counter", "Upstream calls by deployment and outcome")
+metrics.describe("upstream_prompt_tokens_total", "counter", "Prompt tokens reported by the upstream")
+metrics.describe("upstream_completion_tokens_total", "counter", "Completion tokens reported by the upstream")
+metrics.describe("ratelimit_reserved_tokens_total", "counter", "Tokens reserved before sending, from the prompt estimate and max_tokens")
+metrics.describe("ratelimit_wait_seconds", "histogram", "Time an upstream call waited for the rate limiter")
+metrics.describe("ratelimit_waiting", "gauge", "Upstream calls queued in the rate limiter")
+metrics.describe("ratelimit_paused_seconds", "gauge", "Remaining pause after an upstream 429")
+metrics.describe("ratelimit_requests_available", "gauge", "Requests left in the RPM bucket")
+metrics.describe("ratelimit_tokens_available", "gauge", "Tokens left in the TPM bucket")
+metrics.describe("ratelimit_quota", "gauge", "Configured quota per minute by kind (rpm, tpm)")
+metrics.describe("ratelimit_chars_per_token", "gauge", "Calibrated characters per prompt token of the estimate")
+metrics.describe("request_log_records_total", "counter", "Request log records by outcome (written, dropped on a full queue, sampled out)")
+metrics.describe("request_log_queued", "gauge", "Request log records waiting for the writer thread")
+
+# Requests are logged by a background writer so the request path never waits on I/O
+request_log = request_log_from_args(args)
+atexit.register(request_log.close)
+
+# Costs are accumulated in memory and written to the cost file periodically and at shutdown
+cost_ledger = CostLedger(args.cost_file, COST_MAP, flush_interval=args.cost_flush_interval)
+atexit.register(cost_ledger.close)
+
+# Bounded queues in front of the upstream deployment: excess requests get 429/503 with Retry-After
+admission = admission_from_args(args)
+
 # Request body model
 class ChatRequest(BaseModel):
     messages: list  # Chat message history in the format [{"role": "user", "content": "message content"}]
     max_tokens: int  # Default maximum output of 200 tokens
     temperature: float  # Temperature for randomness in the output
     top_p: float  # Top-p sampling parameter
+    stream: bool = False  # Send the reply as server-sent events while it is generated
 
 
-@app.post("/v1/chat/completions")
-async def chat_openai(request: ChatRequest):
+class BatchRequest(BaseModel):
+    requests: list[ChatRequest]  # Conversations with their own sampling parameters
+    stream: bool = False  # Return NDJSON lines as entries complete instead of one ordered list
+
+
+def retry_after_seconds(error):
+    headers = error.response.headers if getattr(error, "response", None) is not None else {}
     try:
-        # Call Azure OpenAI API
-        response = aoiclient.chat.completions.create(
-            model=model_name,
-            messages=request.messages,
-            max_tokens=request.max_tokens,
-            temperature=request.temperature,
-            top_p=request.top_p,
-        )
-
-        # Retrieve the number of input and output tokens
-        usage = response.usage
-        prompt_tokens = usage.prompt_tokens  # Number of input tokens
-        completion_tokens = usage.completion_tokens  # Number of output tokens
-        total_tokens = usage.total_tokens  # Total number of tokens
-
-        # Define cost information for each model
-        cost_map = {
-            "GPT-4-Turbo": (0.01, 0.03),
-            "GPT-4o": (0.005, 0.015),
-            "GPT-35-Turbo": (0.001, 0.002),
-            "GPT-4o-mini": (0.00015, 0.0006),
-            "o1-preview": (0.015, 0.06),
-        }
-
-        # Check if the model name is valid
-        if model_name not in cost_map:
-            raise HTTPException(status_code=500, detail="Undefined model name")
-
-        # Calculate costs based on token usage
-        input_cost_per_1000_tokens, output_cost_per_1000_tokens = cost_map[model_name]
-        total_cost = (prompt_tokens / 1000) * input_cost_per_1000_tokens + (completion_tokens / 1000) * output_cost_per_1000_tokens
-
-        print(f"Total cost: ${total_cost:.6f}")
-        print(response)
-
-        # Read and update cost.json file
-        if os.path.exists("cost.json"):
-            with open("cost.json", "r") as f:
-                cost_all = json.load(f)
-        else:
-            cost_all = {}
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        return float(headers.get("retry-after", 1.0))
+    except ValueError:
+        return 1.0
+
 
-        # Update the total cost for the model
-        if model_name in cost_all:
-            cost_all[model_name] += total_cost
+async def send_upstream(request: ChatRequest, **kwargs):
+    # Call Azure OpenAI API once the rate limiter has the budget for it. A 429 pauses every queued call for its
+    # Retry-After before this one is retried; connection errors and 5xx back off on their own.
+    for attempt in range(args.upstream_retries + 1):
+        reservation = await rate_limiter.acquire(request.messages, request.max_tokens)
+        metrics.observe("ratelimit_wait_seconds", reservation.wait, deployment=model_name)
+        try:
+            response = await aoiclient.chat.completions.create(
+                model=model_name,
+                messages=request.messages,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                **kwargs,
+            )
+        except openai.RateLimitError as e:
+            rate_limiter.cancel(reservation)
+            rate_limiter.pause(retry_after_seconds(e))
+            metrics.inc("upstream_requests_total", deployment=model_name, status="throttled")
+            if attempt == args.upstream_retries:
+                raise
+        except (openai.APIConnectionError, openai.InternalServerError):
+            rate_limiter.cancel(reservation)
+            metrics.inc("upstream_requests_total", deployment=model_name, status="error")
+            if attempt == args.upstream_retries:
+                raise
+            await asyncio.sleep(random.uniform(0, min(2 ** attempt, 30)))
         else:
-            cost_all[model_name] = total_cost
+            metrics.inc("upstream_requests_total", deployment=model_name, status="ok")
+            metrics.inc("ratelimit_reserved_tokens_total", reservation.tokens, deployment=model_name)
+            return reservation, response
+
+
+def settle_usage(reservation, usage):
+    rate_limiter.settle(reservation, usage.prompt_tokens, usage.completion_tokens)
+    metrics.inc("upstream_prompt_tokens_total", usage.prompt_tokens, deployment=model_name)
+    metrics.inc("upstream_completion_tokens_total", usage.completion_tokens, deployment=model_name)
+
+
+async def complete(request: ChatRequest, run=None):
+    # `run` is the client's optional run tag, under which the cost is also accounted
+    started = time.perf_counter()
+    async with upstream_slots:
+        reservation, response = await send_upstream(request)
+
+    # Retrieve the number of input and output tokens
+    usage = response.usage
+    settle_usage(reservation, usage)
+    total_cost = cost_ledger.record(model_name, usage.prompt_tokens, usage.completion_tokens, run)
+    content = response.choices[0].message.content
+    request_log.log({
+        "event": "completion",
+        "run": run,
+        "prompt": request.messages[-1]["content"],
+        "response": content,
+        "finish_reason": response.choices[0].finish_reason,
+        "usage": usage.model_dump(),
+        "cost": total_cost,
+        "latency": time.perf_counter() - started,
+    })
+
+    return content.strip()
+
 
-        # Write the updated cost data back to the file
-        with open("cost.json", "w") as f:
-            json.dump(cost_all, f, indent=4)
+async def stream_complete(request: ChatRequest, run=None):
+    # Relay the upstream stream delta by delta. If our client disconnects, this generator is dropped and
+    # closing the upstream stream stops the generation there too. The stream holds its upstream slot until it ends.
+    async with upstream_slots:
+        reservation, stream = await send_upstream(request, stream=True, stream_options={"include_usage": True})
+        started = time.perf_counter()
+        parts = []
+        usage, total_cost, finish_reason, failed = None, None, None, False
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+                # Usage arrives in a final chunk without choices; a stream cancelled before it is not costed, and
+                # keeps its full reservation in the rate limiter
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                    settle_usage(reservation, usage)
+                    total_cost = cost_ledger.record(model_name, usage.prompt_tokens, usage.completion_tokens, run)
+        except Exception as e:
+            failed = True
+            request_log.log({"event": "error", "error": str(e)}, always=True)
+            raise
+        finally:
+            await stream.close()
+            # Logged with the text sent so far, also when the client closed the stream early
+            if not failed:
+                request_log.log({
+                    "event": "completion",
+                    "run": run,
+                    "prompt": request.messages[-1]["content"],
+                    "response": "".join(parts),
+                    "finish_reason": finish_reason or "cancelled",
+                    "usage": usage.model_dump() if usage is not None else None,
+                    "cost": total_cost,
+                    "latency": time.perf_counter() - started,
+                })
 
-        return response.choices[0].message.content.strip()
+
+@app.post("/v1/chat/completions")
+async def chat_openai(request: ChatRequest, x_run_tag: Optional[str] = Header(default=None)):
+    release = await admission.acquire("chat_completions")
+    try:
+        if request.stream:
+            # A stream keeps its slot until it ends
+            response = sse_response(stream_complete(request, x_run_tag), model=model_name, on_close=release)
+            release = None
+            return response
+        return await complete(request, x_run_tag)
     except Exception as e:
+        request_log.log({"event": "error", "error": str(e)}, always=True)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if release is not None:
+            release()
+
+
+@app.post("/v1/chat/completions/batch")
+async def chat_openai_batch(request: BatchRequest, x_run_tag: Optional[str] = Header(default=None)):
+    # Entries are sent upstream in parallel; results come back in order, or streamed as NDJSON
+    release = await admission.acquire("batch")
+    return await run_batch(request.requests, lambda entry: complete(entry, x_run_tag), request.stream, on_close=release)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    stats = rate_limiter.stats()
+    metrics.set("ratelimit_waiting", stats["waiting"], deployment=model_name)
+    metrics.set("ratelimit_paused_seconds", stats["paused_seconds"], deployment=model_name)
+    metrics.set("ratelimit_chars_per_token", stats["chars_per_token"], deployment=model_name)
+    metrics.set("ratelimit_quota", stats["rpm"], deployment=model_name, kind="rpm")
+    metrics.set("ratelimit_quota", stats["tpm"], deployment=model_name, kind="tpm")
+    if stats["requests_available"] is not None:
+        metrics.set("ratelimit_requests_available", stats["requests_available"], deployment=model_name)
+    if stats["tokens_available"] is not None:
+        metrics.set("ratelimit_tokens_available", stats["tokens_available"], deployment=model_name)
+    log_stats = request_log.stats()
+    for outcome in ("written", "dropped", "sampled_out"):
+        metrics.set("request_log_records_total", log_stats[outcome], outcome=outcome)
+    metrics.set("request_log_queued", log_stats["queued"])
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cost")
+async def get_cost(run: Optional[str] = None):
+    # Accumulated cost and tokens per model, including what is not yet written to the cost file; `run` narrows it
+    # to one run tag
+    ledger = cost_ledger.snapshot()
+    if run is None:
+        return ledger
+    return {model: entry["runs"][run] for model, entry in ledger.items() if run in entry["runs"]}
 
 
 if __name__ == "__main__":
@@ -1,70 +1,372 @@
 import argparse
-from fastapi import FastAPI, Request
-import torch
+import atexit
+import contextlib
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+from serving_admission import AdmissionController, add_admission_args, admission_from_args
+from serving_batch import run_batch
+from serving_log import add_request_log_args, request_log_from_args
+from serving_metrics import ServingMetrics
+from serving_stream import sse_response
 import uvicorn
 import json
 import datetime
+import math
 import os
+import time
+import uuid
+from functools import lru_cache
 
-from vllm import LLM, SamplingParams
 from transformers import AutoTokenizer
 
-app = FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    # uvicorn re-raises SIGTERM/SIGINT after a graceful shutdown, so atexit handlers do not run then
+    if request_log is not None:
+        request_log.close()
 
-# Automatically select GPUs based on available devices
-gpu_count = torch.cuda.device_count()
-if gpu_count > 0:
-    # Set CUDA_VISIBLE_DEVICES to use all available GPUs
-    os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(str(i) for i in range(gpu_count))
-else:
-    print("No GPU found. Defaulting to CPU.")
-    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+app = FastAPI(lifespan=lifespan)
 
-# Global variables for model and tokenizer
+# Global variables for model and tokenizer. `model` is the selected backend: vLLM's AsyncLLMEngine, or
+# serving_cpu.TransformersEngine, which mirrors the part of its interface used here. The backend also provides
+# the SamplingParams and GuidedDecodingParams classes; both are imported in __main__ so that neither backend's
+# dependencies are needed to load this module.
 model = None
 tokenizer = None
+SamplingParams = None
+GuidedDecodingParams = None
+
+# Prompt tokens seen and served from the automatic prefix cache since startup
+prefix_stats = {"requests": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0}
+
+# Conversation head (every message but the last one's content) -> (token ids of the rendered template up to that
+# content, template text after it), or None if the template cannot be split there without changing the tokens
+template_prefixes = {}
+MAX_TEMPLATE_PREFIXES = 1024
+TEMPLATE_PLACEHOLDER = "\x00content\x00"
+
+# Background JSONL log of every request, set up in __main__
+request_log = None
+
+# Per-endpoint concurrency limits and bounded queues, configured in __main__; unlimited by default
+admission = AdmissionController()
+
+# Served on /metrics in the Prometheus text format
+metrics = ServingMetrics("motivebench")
+metrics.describe("requests_total", "counter", "HTTP requests by endpoint and outcome")
+metrics.describe("admission_running", "gauge", "Requests holding a slot of a concurrency-limited endpoint")
+metrics.describe("admission_waiting", "gauge", "Requests queued for a slot of a concurrency-limited endpoint")
+metrics.describe("engine_requests_in_flight", "gauge", "Generation requests currently inside the engine")
+metrics.describe("queue_wait_seconds", "histogram", "Time from arrival in the engine to first scheduling")
+metrics.describe("time_to_first_token_seconds", "histogram", "Time from submission to the first engine output")
+metrics.describe("generation_seconds", "histogram", "Time from submission to the last engine output")
+metrics.describe("prompt_tokens_total", "counter", "Prompt tokens processed")
+metrics.describe("cached_prompt_tokens_total", "counter", "Prompt tokens served from the prefix cache")
+metrics.describe("completion_tokens_total", "counter", "Completion tokens generated")
+metrics.describe("request_log_records_total", "counter", "Request log records by outcome (written, dropped on a full queue, sampled out)")
+metrics.describe("request_log_queued", "gauge", "Request log records waiting for the writer thread")
+metrics.set("engine_requests_in_flight", 0)
+
+def new_usage():
+    return {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+async def stream_generate(inputs, sampling_params, usage=None):
+    # Concurrent requests join the engine's continuous batch. Outputs are cumulative; if the consumer stops
+    # iterating (e.g. its client disconnected), the engine aborts the request and frees its KV blocks.
+    # Token counts are added to `usage`, if given, once the request ends.
+    started = time.perf_counter()
+    output = None
+    metrics.inc("engine_requests_in_flight")
+    try:
+        async for output in model.generate(inputs, sampling_params, request_id=uuid.uuid4().hex):
+            if started is not None:
+                # The prompt is fully known after prefill, so cancelled requests are accounted for too
+                metrics.observe("time_to_first_token_seconds", time.perf_counter() - started)
+                cached_tokens = getattr(output, "num_cached_tokens", None) or 0
+                prefix_stats["requests"] += 1
+                prefix_stats["prompt_tokens"] += len(output.prompt_token_ids)
+                prefix_stats["cached_prompt_tokens"] += cached_tokens
+                metrics.inc("prompt_tokens_total", len(output.prompt_token_ids))
+                metrics.inc("cached_prompt_tokens_total", cached_tokens)
+                submitted, started = started, None
+            yield output
+    finally:
+        metrics.dec("engine_requests_in_flight")
+        if output is not None:
+            metrics.observe("generation_seconds", time.perf_counter() - submitted)
+            request_metrics = getattr(output, "metrics", None)
+            if request_metrics is not None and request_metrics.first_scheduled_time is not None:
+                metrics.observe("queue_wait_seconds", request_metrics.first_scheduled_time - request_metrics.arrival_time)
+            completion_tokens = len(output.outputs[0].token_ids)
+            metrics.inc("completion_tokens_total", completion_tokens)
+            if usage is not None:
+                usage["prompt_tokens"] += len(output.prompt_token_ids)
+                usage["completion_tokens"] += completion_tokens
+                usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+async def generate(inputs, sampling_params, usage=None):
+    output = None
+    async for output in stream_generate(inputs, sampling_params, usage):
+        pass
+    return output
+
+@lru_cache(maxsize=None)
+def choice_token_ids(choices):
+    # Map token ids to option letters; a letter may be emitted with or without a leading space depending on the template
+    token_choices = {}
+    for choice in choices:
+        for variant in (choice, " " + choice):
+            token_ids = tokenizer.encode(variant, add_special_tokens=False)
+            if len(token_ids) == 1:
+                token_choices.setdefault(token_ids[0], choice)
+    return token_choices
+
+async def score_choices(inputs, choices, usage=None):
+    # A single prefill: the next token is restricted to the option letters and their log-probabilities are returned
+    token_choices = choice_token_ids(tuple(choices))
+    sampling_params = SamplingParams(temperature=0.0, max_tokens=1, logprobs=len(token_choices), allowed_token_ids=list(token_choices))
+    output = await generate(inputs, sampling_params, usage)
+    top_logprobs = output.outputs[0].logprobs[0]
+
+    scores = {}
+    for token_id, logprob in top_logprobs.items():
+        choice = token_choices.get(token_id)
+        if choice is not None:
+            scores[choice] = sum_logprobs(scores[choice], logprob.logprob) if choice in scores else logprob.logprob
+
+    # Renormalize over the options; letters that received no probability mass are reported as null
+    norm = sum_logprobs(*scores.values())
+    logprobs = {choice: scores[choice] - norm if choice in scores else None for choice in choices}
+    return {"choice": max(scores, key=scores.get), "logprobs": logprobs, "usage": usage}
+
+def sum_logprobs(*logprobs):
+    peak = max(logprobs)
+    return peak + math.log(sum(math.exp(logprob - peak) for logprob in logprobs))
+
+def guided_decoding_params(json_post_raw):
+    # At most one constraint applies: a fixed set of choices, a regular expression or a JSON schema
+    if json_post_raw.get('allowed_choices'):
+        return GuidedDecodingParams(choice=json_post_raw['allowed_choices'])
+    if json_post_raw.get('guided_regex'):
+        return GuidedDecodingParams(regex=json_post_raw['guided_regex'])
+    if json_post_raw.get('guided_json'):
+        return GuidedDecodingParams(json=json_post_raw['guided_json'])
+    return None
+
+async def generate_with_final_choice(inputs, sampling_params, choices, usage=None):
+    # Free-form reasoning first, then a final line that is guaranteed to be one of `choices`
+    sampling_params.max_tokens = max(sampling_params.max_tokens - 1, 1)
+    reasoning = (await generate(inputs, sampling_params, usage)).outputs[0].text.rstrip()
+    final_params = SamplingParams(temperature=0.0, max_tokens=1, guided_decoding=GuidedDecodingParams(choice=choices))
+    final_inputs = {"prompt_token_ids": inputs["prompt_token_ids"] + tokenizer.encode(reasoning + "\n", add_special_tokens=False)}
+    choice = (await generate(final_inputs, final_params, usage)).outputs[0].text
+    return reasoning + "\n" + choice
+
+def render_token_ids(messages):
+    return tokenizer.encode(tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True))
+
+def chat_token_ids(messages):
+    # Every evaluation request shares the system prompt and template head, so those are rendered and tokenized
+    # once; only the last message's content (and the short template tail) is tokenized per request
+    content = messages[-1]["content"]
+    if content[:1].isspace() or content[-1:].isspace():
+        # Leading whitespace merges with the end of the head in some pre-tokenizers (Qwen's \s*[\r\n]+ joins
+        # "\n" + "\n" into one token), and templates may trim the content, so only the full render is exact
+        return render_token_ids(messages)
+    head = json.dumps(messages[:-1] + [{**messages[-1], "content": None}], sort_keys=True)
+    prefix = template_prefixes.get(head, False)
+    if prefix is None:
+        return render_token_ids(messages)
+    if prefix is not False:
+        prefix_ids, tail = prefix
+        return prefix_ids + tokenizer.encode(content + tail, add_special_tokens=False)
+
+    # First request with this head: split the template around a placeholder, and keep the split only if it
+    # reproduces the tokens of the whole rendered prompt
+    token_ids = render_token_ids(messages)
+    template = tokenizer.apply_chat_template(messages[:-1] + [{**messages[-1], "content": TEMPLATE_PLACEHOLDER}],
+                                             tokenize=False, add_generation_prompt=True)
+    prefix = None
+    if template.count(TEMPLATE_PLACEHOLDER) == 1:
+        before, tail = template.split(TEMPLATE_PLACEHOLDER)
+        prefix_ids = tokenizer.encode(before)
+        if prefix_ids + tokenizer.encode(content + tail, add_special_tokens=False) == token_ids:
+            prefix = (prefix_ids, tail)
+    if len(template_prefixes) < MAX_TEMPLATE_PREFIXES:
+        template_prefixes[head] = prefix
+    return token_ids
+
+def prompt_of(json_post_raw):
+    # Clients may send the prompt already tokenized (client_eval.py --pretokenize); the engine then skips tokenization
+    if json_post_raw.get('prompt_token_ids'):
+        return {"prompt_token_ids": json_post_raw['prompt_token_ids']}
+    return {"prompt_token_ids": chat_token_ids(json_post_raw.get('messages'))}
+
+def sampling_params_of(json_post_raw, guided=True):
+    return SamplingParams(temperature=json_post_raw.get('temperature'), top_p=json_post_raw.get('top_p'),
+                          repetition_penalty=json_post_raw.get('repetition_penalty'), max_tokens=json_post_raw.get('max_tokens'),
+                          guided_decoding=guided_decoding_params(json_post_raw) if guided else None)
+
+def log_completion(messages, inputs, response, finish_reason, usage, started, **fields):
+    if request_log is not None:
+        request_log.log({
+            "event": "completion",
+            "prompt": messages[-1]['content'] if messages else f"<{len(inputs['prompt_token_ids'])} token ids>",
+            "response": response,
+            "finish_reason": finish_reason,
+            **fields,
+            "usage": usage,
+            "latency": time.perf_counter() - started,
+        })
+
+async def complete(json_post_raw, usage=None):
+    # Returns an OpenAI chat.completion object with a usage block, or the option log-probabilities when scoring
+    usage = new_usage() if usage is None else usage
+    started = time.perf_counter()
+    messages = json_post_raw.get('messages')
+    logprob_choices = json_post_raw.get('logprob_choices')
+
+    inputs = prompt_of(json_post_raw)
+    if logprob_choices:
+        scores = await score_choices(inputs, logprob_choices, usage)
+        log_completion(messages, inputs, scores["choice"], "length", usage, started, logprobs=scores["logprobs"])
+        return scores
+
+    allowed_choices = json_post_raw.get('allowed_choices')
+
+    if allowed_choices and json_post_raw.get('reasoning'):
+        response = await generate_with_final_choice(inputs, sampling_params_of(json_post_raw, guided=False), allowed_choices, usage)
+        finish_reason = "stop"
+    else:
+        output = await generate(inputs, sampling_params_of(json_post_raw), usage)
+        response = output.outputs[0].text
+        finish_reason = output.outputs[0].finish_reason
+
+    now = datetime.datetime.now()
+    answer = {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(now.timestamp()),
+        "model": args.model,
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": response,
+            },
+            "finish_reason": finish_reason,
+        }],
+        "usage": usage,
+    }
+    log_completion(messages, inputs, response, finish_reason, usage, started)
+    return answer
+
+async def stream_complete(json_post_raw, usage):
+    # Yields the reply as text deltas while it is decoded. The two-stage constrained CoT needs the whole
+    # reasoning before its final line, so it is sent as one delta.
+    if json_post_raw.get('allowed_choices') and json_post_raw.get('reasoning'):
+        yield (await complete(json_post_raw, usage))["choices"][0]["message"]["content"]
+        return
+    started = time.perf_counter()
+    inputs = prompt_of(json_post_raw)
+    text, finish_reason, failed = "", None, False
+    outputs = stream_generate(inputs, sampling_params_of(json_post_raw), usage)
+    try:
+        async for output in outputs:
+            sent = len(text)
+            text, finish_reason = output.outputs[0].text, output.outputs[0].finish_reason
+            yield text[sent:]
+    except Exception as e:
+        failed = True
+        if request_log is not None:
+            request_log.log({"event": "error", "error": f"An error occurred: {str(e)}"}, always=True)
+        raise
+    finally:
+        # Closing the generation fills in `usage`, also when the client went away mid-stream
+        await outputs.aclose()
+        if not failed:
+            log_completion(json_post_raw.get('messages'), inputs, text, finish_reason or "cancelled", usage, started)
+
+async def admit(endpoint):
+    # Over-limit requests are answered with 429/503 and Retry-After before any work is done for them
+    try:
+        return await admission.acquire(endpoint)
+    except HTTPException as e:
+        metrics.inc("requests_total", endpoint=endpoint, status=f"rejected_{e.status_code}")
+        raise
 
 @app.post("/v1/chat/completions")
 async def create_item(request: Request):
     global model, tokenizer
+    release = await admit("chat_completions")
     try:
         json_post_raw = await request.json()
-        max_length = json_post_raw.get('max_tokens')
-        top_p = json_post_raw.get('top_p')
-        temperature = json_post_raw.get('temperature')
-        messages = json_post_raw.get('messages')
-        repetition_penalty = json_post_raw.get('repetition_penalty')
-
-        sampling_params = SamplingParams(temperature=temperature, top_p=top_p, repetition_penalty=repetition_penalty, max_tokens=max_length)
-
-        inputs = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        outputs = model.generate(inputs, sampling_params)
-        response = outputs[0].outputs[0].text
-
-        now = datetime.datetime.now()
-        time = now.strftime("%Y-%m-%d %H:%M:%S")
-        answer = {
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": response,
-                }
-            }],
-        }
-        log = f"[{time}] prompt: {messages[0]['content']}, response: {repr(response)}"
-        print(log)
-        return answer["choices"][0]["message"]["content"]
+        # Log-probability scoring decodes nothing, so there is nothing to stream
+        if json_post_raw.get('stream') and not json_post_raw.get('logprob_choices'):
+            usage = new_usage()
+            # A stream keeps its slot until it ends
+            response = sse_response(stream_complete(json_post_raw, usage), model=args.model, usage=usage, on_close=release)
+            release = None
+        else:
+            response = await complete(json_post_raw)
+        metrics.inc("requests_total", endpoint="chat_completions", status="ok")
+        return response
 
     except Exception as e:
+        metrics.inc("requests_total", endpoint="chat_completions", status="error")
         error_message = f"An error occurred: {str(e)}"
-        print(error_message)
-        return {"error": error_message}
+        if request_log is not None:
+            request_log.log({"event": "error", "error": error_message}, always=True)
+        # A 200 would let clients take the error for a reply and cache it
+        raise HTTPException(status_code=500, detail=error_message)
+
+    finally:
+        if release is not None:
+            release()
+
+@app.post("/v1/chat/completions/batch")
+async def create_batch(request: Request):
+    # A list of conversations, each with its own sampling params, in one HTTP round trip. All entries join the
+    # engine's batch at once; results come back in order, or as NDJSON lines in completion order with "stream": true.
+    json_post_raw = await request.json()
+    release = await admit("batch")
+    metrics.inc("requests_total", endpoint="batch", status="ok")
+    return await run_batch(json_post_raw.get('requests', []), complete, json_post_raw.get('stream', False), on_close=release)
+
+@app.get("/v1/prefix_cache_stats")
+async def get_prefix_cache_stats():
+    prompt_tokens = prefix_stats["prompt_tokens"]
+    return {**prefix_stats, "hit_rate": prefix_stats["cached_prompt_tokens"] / prompt_tokens if prompt_tokens else 0.0}
+
+@app.get("/v1/batcher_stats")
+async def get_batcher_stats():
+    # Batch sizes and queue waits of the transformers backend; vLLM schedules internally and reports nothing here
+    return model.stats() if hasattr(model, "stats") else {}
+
+@app.get("/metrics")
+async def get_metrics():
+    for endpoint, stats in admission.stats().items():
+        metrics.set("admission_running", stats["running"], endpoint=endpoint)
+        metrics.set("admission_waiting", stats["waiting"], endpoint=endpoint)
+    if request_log is not None:
+        log_stats = request_log.stats()
+        for outcome in ("written", "dropped", "sampled_out"):
+            metrics.set("request_log_records_total", log_stats[outcome], outcome=outcome)
+        metrics.set("request_log_queued", log_stats["queued"])
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Run FastAPI server with custom port and model")
     parser.add_argument('--model', type=str, required=True, help="Model to load (e.g., 'microsoft/Phi-3-mini-4k-instruct')")
     parser.add_argument('--port', type=int, default=4000, help="Port to run the server on")
+    parser.add_argument('--backend', default='vllm', choices=['vllm', 'transformers'], help="'vllm' (default, GPU) or 'transformers' (CPU, dynamically batched)")
+    parser.add_argument('--no-prefix-caching', action='store_true', help="Disable vLLM automatic prefix caching")
+    parser.add_argument('--max-num-seqs', type=int, default=None, help="Maximum number of sequences the engine batches together (default: 256 with vllm, 8 with transformers)")
+    parser.add_argument('--batch-window-ms', type=float, default=10.0, help="How long the transformers backend waits for a batch to fill (default: 10)")
+    add_request_log_args(parser, os.path.join("logs", "server_vllm.jsonl"))
+    add_admission_args(parser, ["chat_completions", "batch"])
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -74,7 +376,22 @@ if __name__ == '__main__':
     # Model and tokenizer loading based on provided model name
     model_dir = args.model
     tokenizer = AutoTokenizer.from_pretrained(model_dir, trust_remote_code=True, max_model_len=13552)
-    model = LLM(model_dir, trust_remote_code=True)
+    if args.backend == 'vllm':
+        from vllm import SamplingParams
+        from vllm.engine.arg_utils import AsyncEngineArgs
+        from vllm.engine.async_llm_engine import AsyncLLMEngine
+        from vllm.sampling_params import GuidedDecodingParams
+        # Evaluation prompts share a long instruction header, and the permutations of an item share the whole stem,
+        # so their KV blocks are reused across requests
+        engine_args = AsyncEngineArgs(model=model_dir, trust_remote_code=True, enable_prefix_caching=not args.no_prefix_caching,
+                                      max_num_seqs=args.max_num_seqs or 256, disable_log_requests=True)
+        model = AsyncLLMEngine.from_engine_args(engine_args)
+    else:
+        from serving_cpu import GuidedDecodingParams, SamplingParams, TransformersEngine
+        model = TransformersEngine(model_dir, tokenizer, max_batch_size=args.max_num_seqs or 8, window_ms=args.batch_window_ms)
+    request_log = request_log_from_args(args)
+    atexit.register(request_log.close)
+    admission = admission_from_args(args)
 
     # Running the server with the specified port
     uvicorn.run(app, host='0.0.0.0', port=args.port, workers=1)
@@ -0,0 +1,87 @@
+import asyncio
+from collections import Counter
+
+from fastapi import HTTPException
+
+
+class AdmissionController:
+    """Per-endpoint concurrency limits with a bounded wait queue.
+
+    A request runs once its endpoint has a free slot. While all slots are busy, up to `max_queue` requests wait;
+    beyond that they are rejected with 429, and a request that waited longer than `queue_timeout` seconds gets
+    503. Both carry `Retry-After`, so clients back off instead of piling up. Endpoints without a limit are
+    admitted immediately.
+    """
+
+    def __init__(self, limits=None, max_queue=256, queue_timeout=60.0, retry_after=1):
+        self.limits = dict(limits or {})
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._slots = {endpoint: asyncio.Semaphore(limit) for endpoint, limit in self.limits.items()}
+        self._waiting = Counter()
+        self._running = Counter()
+        self.rejected = Counter()  # (endpoint, status) -> count
+
+    def _reject(self, endpoint, status_code, detail):
+        self.rejected[(endpoint, status_code)] += 1
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+    async def acquire(self, endpoint):
+        # Returns a callable that releases the slot; raises HTTPException(429/503) when the request is not admitted
+        slots = self._slots.get(endpoint)
+        if slots is None:
+            return lambda: None
+        if slots.locked():
+            if self._waiting[endpoint] >= self.max_queue:
+                self._reject(endpoint, 429, f"Too many queued requests for {endpoint}")
+            self._waiting[endpoint] += 1
+            try:
+                await asyncio.wait_for(slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._reject(endpoint, 503, f"Timed out after {self.queue_timeout}s in the {endpoint} queue")
+            finally:
+                self._waiting[endpoint] -= 1
+        else:
+            await slots.acquire()
+        self._running[endpoint] += 1
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._running[endpoint] -= 1
+                slots.release()
+        return release
+
+    def stats(self):
+        return {
+            endpoint: {
+                "limit": limit,
+                "running": self._running[endpoint],
+                "waiting": self._waiting[endpoint],
+                "rejected_429": self.rejected[(endpoint, 429)],
+                "rejected_503": self.rejected[(endpoint, 503)],
+            }
+            for endpoint, limit in self.limits.items()
+        }
+
+
+def parse_limit(value):
+    endpoint, _, limit = value.partition("=")
+    if not limit.isdigit() or int(limit) < 1:
+        raise ValueError(f"Expected ENDPOINT=N with N >= 1, got {value!r}")
+    return endpoint, int(limit)
+
+def add_admission_args(parser, endpoints):
+    parser.add_argument('--concurrency-limit', action='append', default=[], type=parse_limit, metavar="ENDPOINT=N",
+                        help=f"Requests of an endpoint ({', '.join(endpoints)}) served at once; repeat per endpoint (default: unlimited)")
+    parser.add_argument('--max-queue', type=int, default=256, help="Requests that may wait per limited endpoint before new ones get 429 (default: 256)")
+    parser.add_argument('--queue-timeout', type=float, default=60.0, help="Seconds a request may wait for a slot before it gets 503 (default: 60)")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with 429 and 503 (default: 1)")
+
+def admission_from_args(args):
+    return AdmissionController(dict(args.concurrency_limit), max_queue=args.max_queue, queue_timeout=args.queue_timeout,
+                               retry_after=args.retry_after)
@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+
+async def run_batch(entries, complete, stream=False, on_close=None):
+    """Serve a /v1/chat/completions/batch request.
+
+    `complete` is the server's single-conversation coroutine. Every entry is started at once; a failed entry
+    yields {"index": i, "error": ...} without affecting the others. `on_close` is called once the batch is done,
+    or, when streaming, once the response has ended.
+    """
+    async def run_entry(index, entry):
+        try:
+            return {"index": index, "response": await complete(entry)}
+        except Exception as e:
+            return {"index": index, "error": str(e)}
+
+    tasks = [asyncio.ensure_future(run_entry(index, entry)) for index, entry in enumerate(entries)]
+
+    if not stream:
+        try:
+            return {"responses": await asyncio.gather(*tasks)}
+        finally:
+            if on_close:
+                on_close()
+
+    async def ndjson():
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task, ensure_ascii=False) + "\n"
+        finally:
+            # The client went away; do not keep generating for it
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson", background=BackgroundTask(on_close) if on_close else None)
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import time
+from collections import Counter
+
+
+class MicroBatcher:
+    """Aggregates concurrent requests into batched calls of a backend without a scheduler of its own.
+
+    Requests are grouped by their sampling params; a group is flushed once it reaches `max_batch_size` or
+    `window_ms` after its first request arrived, whichever comes first. `generate_batch(prompts, params)` is
+    an async callable returning one output per prompt; at most `max_concurrent_batches` run at a time.
+    """
+
+    def __init__(self, generate_batch, max_batch_size=8, window_ms=10.0, max_concurrent_batches=1):
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self._pending = {}  # params key -> [(prompt, future, arrival time)]
+        self._params = {}
+        self._timers = {}
+        self._slots = asyncio.Semaphore(max_concurrent_batches)
+
+        self.batches = 0
+        self.requests = 0
+        self.flush_reasons = Counter()
+        self.batch_sizes = Counter()
+        self.queue_wait_total = 0.0
+        self.batch_time_total = 0.0
+
+    async def submit(self, prompt, params):
+        key = json.dumps(params, sort_keys=True)
+        future = asyncio.get_running_loop().create_future()
+        group = self._pending.setdefault(key, [])
+        group.append((prompt, future, time.perf_counter()))
+        self._params[key] = params
+
+        if len(group) >= self.max_batch_size:
+            self._flush(key, "full")
+        elif len(group) == 1:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._flush, key, "window")
+        return await future
+
+    def _flush(self, key, reason):
+        group = self._pending.pop(key, None)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if group:
+            self.flush_reasons[reason] += 1
+            asyncio.get_running_loop().create_task(self._run(group, self._params.pop(key)))
+
+    async def _run(self, group, params):
+        async with self._slots:
+            started = time.perf_counter()
+            self.batches += 1
+            self.requests += len(group)
+            self.batch_sizes[len(group)] += 1
+            self.queue_wait_total += sum(started - arrival for _, _, arrival in group)
+            try:
+                outputs = await self.generate_batch([prompt for prompt, _, _ in group], params)
+            except Exception as e:
+                for _, future, _ in group:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            finally:
+                self.batch_time_total += time.perf_counter() - started
+
+        for (_, future, _), output in zip(group, outputs):
+            if not future.done():
+                future.set_result(output)
+
+    def stats(self):
+        # Exposes the window/batch-size trade-off: bigger batches cost queue wait, small windows cost batch efficiency
+        return {
+            "max_batch_size": self.max_batch_size,
+            "window_ms": self.window * 1000,
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "flush_reasons": dict(self.flush_reasons),
+            "mean_queue_wait_ms": 1000 * self.queue_wait_total / self.requests if self.requests else 0.0,
+            "mean_batch_time_ms": 1000 * self.batch_time_total / self.batches if self.batches else 0.0,
+            "pending": sum(len(group) for group in self._pending.values()),
+        }
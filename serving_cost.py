@@ -0,0 +1,124 @@
+import contextlib
+import json
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: flushes from several servers are not serialized
+    fcntl = None
+
+
+def new_totals():
+    return {"cost": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "requests": 0}
+
+def add_totals(totals, delta):
+    for key in ("cost", "prompt_tokens", "completion_tokens", "requests"):
+        totals[key] += delta[key]
+
+def merge(ledger, delta):
+    # Adds one ledger ({model: {totals..., "runs": {tag: totals}}}) into another, in place
+    for model, model_delta in delta.items():
+        entry = ledger.setdefault(model, {**new_totals(), "runs": {}})
+        add_totals(entry, model_delta)
+        for run, run_delta in model_delta["runs"].items():
+            add_totals(entry["runs"].setdefault(run, new_totals()), run_delta)
+    return ledger
+
+
+class CostLedger:
+    """Running API cost per model and run tag, kept in memory and flushed to a JSON file.
+
+    `record` only updates counters. A background thread flushes on a timer and `close` flushes once more at
+    shutdown. A flush re-reads the file and adds only what was recorded since the previous flush, so servers that
+    share the file keep each other's totals; an advisory lock on `<path>.lock` serializes their flushes. The file is
+    written to a temporary name and renamed over the old one, so it is never seen half-written.
+    """
+
+    def __init__(self, path, prices, flush_interval=5.0):
+        self.path = path
+        self.prices = prices  # model -> (input, output) cost per 1000 tokens
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self._lock = threading.Lock()
+        self._totals = self._read()  # as of the last flush, plus everything pending
+        self._pending = {}  # same layout, recorded since the last flush
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="cost-ledger", daemon=True)
+        self._thread.start()
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        input_cost_per_1000_tokens, output_cost_per_1000_tokens = self.prices[model]
+        return (prompt_tokens / 1000) * input_cost_per_1000_tokens + (completion_tokens / 1000) * output_cost_per_1000_tokens
+
+    def record(self, model, prompt_tokens, completion_tokens, run=None):
+        # Returns the cost of this call
+        total_cost = self.cost(model, prompt_tokens, completion_tokens)
+        totals = {"cost": total_cost, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "requests": 1}
+        delta = {model: {**totals, "runs": {run: totals} if run is not None else {}}}
+        with self._lock:
+            merge(self._totals, delta)
+            merge(self._pending, delta)
+        return total_cost
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._totals))
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            ledger = json.load(f)
+        # Files written before the ledger hold a bare total cost per model
+        return {model: {**entry, "runs": entry.get("runs", {})} if isinstance(entry, dict) else {**new_totals(), "cost": entry, "runs": {}}
+                for model, entry in ledger.items()}
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            with self._file_lock():
+                ledger = merge(self._read(), pending)
+                fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".", suffix=".tmp", dir=os.path.dirname(self.path) or ".")
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(ledger, f, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+        except Exception:
+            # Keep the unflushed amounts for the next attempt
+            with self._lock:
+                merge(self._pending, pending)
+            raise
+        with self._lock:
+            # The file now also holds what other servers sharing it have recorded; add what arrived during the write
+            self._totals = merge(ledger, self._pending)
+            self.flushes += 1
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except (OSError, ValueError) as e:
+                print(f"Cost ledger flush to {self.path} failed: {e}")
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
@@ -0,0 +1,176 @@
+import asyncio
+import time
+from collections import namedtuple
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from serving_batcher import MicroBatcher
+
+# CPU backend for server_vllm.py: a transformers model behind the subset of vLLM's AsyncLLMEngine interface the
+# server uses. Concurrent requests are grouped into batches by MicroBatcher; each batch is decoded step by step
+# with the KV cache carried across steps, so a step only runs the newest token of every sequence.
+
+Logprob = namedtuple("Logprob", ["logprob"])
+CompletionOutput = namedtuple("CompletionOutput", ["text", "token_ids", "finish_reason", "logprobs"])
+RequestMetrics = namedtuple("RequestMetrics", ["arrival_time", "first_scheduled_time"])
+RequestOutput = namedtuple("RequestOutput", ["request_id", "prompt_token_ids", "outputs", "num_cached_tokens", "metrics", "finished"])
+
+
+class GuidedDecodingParams:
+    """Same constructor as vLLM's; only single-token `choice` constraints are supported on CPU."""
+
+    def __init__(self, choice=None, regex=None, json=None):
+        if regex is not None or json is not None:
+            raise ValueError("The transformers backend only supports guided decoding with `choice`")
+        self.choice = choice
+
+
+class SamplingParams:
+    """Same constructor as the vLLM sampling parameters used by server_vllm.py."""
+
+    def __init__(self, temperature=1.0, top_p=1.0, repetition_penalty=1.0, max_tokens=16, logprobs=None,
+                 allowed_token_ids=None, guided_decoding=None):
+        self.temperature = temperature if temperature is not None else 1.0
+        self.top_p = top_p if top_p is not None else 1.0
+        self.repetition_penalty = repetition_penalty if repetition_penalty is not None else 1.0
+        self.max_tokens = max_tokens if max_tokens is not None else 16
+        self.logprobs = logprobs
+        self.allowed_token_ids = allowed_token_ids
+        self.guided_decoding = guided_decoding
+
+    def to_dict(self):
+        # Requests are only batched together if these match
+        params = dict(vars(self))
+        params["guided_decoding"] = vars(self.guided_decoding) if self.guided_decoding is not None else None
+        return params
+
+
+class TransformersEngine:
+    """Dynamically batched CPU inference with a transformers causal LM.
+
+    Requests wait up to `window_ms` for up to `max_batch_size` others with the same sampling params. A batch is
+    left-padded and decoded in lockstep in a worker thread, so the event loop keeps accepting requests; rows that
+    finish early stop contributing tokens but stay in the batch until it completes.
+    """
+
+    def __init__(self, model_dir, tokenizer, max_batch_size=8, window_ms=10.0, dtype=torch.float32):
+        self.tokenizer = tokenizer
+        self.model = AutoModelForCausalLM.from_pretrained(model_dir, torch_dtype=dtype, trust_remote_code=True)
+        self.model.eval()
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        eos = self.model.generation_config.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, list) else [eos if eos is not None else tokenizer.eos_token_id])
+        self.batcher = MicroBatcher(self._generate_batch, max_batch_size=max_batch_size, window_ms=window_ms)
+
+    async def generate(self, inputs, sampling_params, request_id):
+        # Yields a single, final output: a batch only completes as a whole
+        arrival = time.time()
+        prompt_token_ids = list(inputs["prompt_token_ids"])
+        params = sampling_params.to_dict()
+        token_ids, finish_reason, logprobs, scheduled = await self.batcher.submit((prompt_token_ids, arrival), params)
+        text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+        yield RequestOutput(request_id, prompt_token_ids, [CompletionOutput(text, token_ids, finish_reason, logprobs)], 0,
+                            RequestMetrics(arrival, scheduled), True)
+
+    async def _generate_batch(self, prompts, params):
+        return await asyncio.to_thread(self._decode_batch, [prompt for prompt, _ in prompts], params)
+
+    def _allowed_tokens(self, params):
+        if params["guided_decoding"] is not None and params["guided_decoding"]["choice"]:
+            allowed = []
+            for choice in params["guided_decoding"]["choice"]:
+                token_ids = self.tokenizer.encode(choice, add_special_tokens=False)
+                if len(token_ids) != 1:
+                    raise ValueError(f"The transformers backend only supports single-token choices, got {choice!r}")
+                allowed.append(token_ids[0])
+            return allowed, True
+        return params["allowed_token_ids"], False
+
+    @torch.inference_mode()
+    def _decode_batch(self, prompts, params):
+        scheduled = time.time()
+        allowed, single_choice = self._allowed_tokens(params)
+        # A choice constraint emits exactly one of the choices and stops
+        max_tokens = 1 if single_choice else params["max_tokens"]
+        batch_size = len(prompts)
+        width = max(len(prompt) for prompt in prompts)
+
+        input_ids = torch.tensor([[self.pad_token_id] * (width - len(prompt)) + prompt for prompt in prompts])
+        attention_mask = torch.tensor([[0] * (width - len(prompt)) + [1] * len(prompt) for prompt in prompts])
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        seen = None  # tokens seen so far per row, for the repetition penalty
+        allowed_mask = None
+
+        generated = [[] for _ in prompts]
+        finish_reasons = ["length"] * batch_size
+        first_logprobs = [None] * batch_size
+        done = torch.zeros(batch_size, dtype=torch.bool)
+        past_key_values = None
+        for step in range(max_tokens):
+            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                                 past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+            logits = outputs.logits[:, -1, :].float()
+            if seen is None:
+                # Sized from the logits: config.vocab_size may be smaller than the output layer or the tokenizer
+                vocab_size = logits.shape[-1]
+                seen = torch.zeros(batch_size, vocab_size, dtype=torch.bool)
+                for row, prompt in enumerate(prompts):
+                    seen[row, prompt] = True
+                if allowed:
+                    allowed_mask = torch.full((vocab_size,), float("-inf"))
+                    allowed_mask[allowed] = 0.0
+
+            if params["repetition_penalty"] != 1.0:
+                penalized = torch.where(logits < 0, logits * params["repetition_penalty"], logits / params["repetition_penalty"])
+                logits = torch.where(seen, penalized, logits)
+            if allowed_mask is not None:
+                logits = logits + allowed_mask
+            if step == 0 and params["logprobs"]:
+                top = torch.log_softmax(logits, dim=-1).topk(params["logprobs"], dim=-1)
+                for row in range(batch_size):
+                    first_logprobs[row] = [{token_id: Logprob(logprob) for token_id, logprob in zip(top.indices[row].tolist(), top.values[row].tolist())}]
+            next_tokens = self._sample(logits, params["temperature"], params["top_p"])
+
+            next_tokens = torch.where(done, torch.full_like(next_tokens, self.pad_token_id), next_tokens)
+            for row, token_id in enumerate(next_tokens.tolist()):
+                if done[row]:
+                    continue
+                if token_id in self.eos_token_ids:
+                    finish_reasons[row] = "stop"
+                    done[row] = True
+                    continue
+                generated[row].append(token_id)
+                seen[row, token_id] = True
+            if single_choice:
+                finish_reasons = ["stop"] * batch_size
+            if done.all():
+                break
+
+            # Only the newest token goes through the model; everything before it is in the KV cache
+            input_ids = next_tokens.unsqueeze(-1)
+            attention_mask = torch.cat([attention_mask, (~done).long().unsqueeze(-1)], dim=-1)
+            position_ids = position_ids[:, -1:] + 1
+
+        return [(generated[row], finish_reasons[row], first_logprobs[row], scheduled) for row in range(batch_size)]
+
+    @staticmethod
+    def _sample(logits, temperature, top_p):
+        if temperature <= 0:
+            return logits.argmax(dim=-1)
+        probs = torch.softmax(logits / temperature, dim=-1)
+        if top_p < 1.0:
+            sorted_probs, order = probs.sort(dim=-1, descending=True)
+            # Keep the smallest prefix whose mass reaches top_p (always at least the most likely token)
+            outside = sorted_probs.cumsum(dim=-1) - sorted_probs > top_p
+            sorted_probs = sorted_probs.masked_fill(outside, 0.0)
+            probs = torch.zeros_like(probs).scatter(-1, order, sorted_probs)
+        return torch.multinomial(probs, 1).squeeze(-1)
+
+    async def abort(self, request_id):
+        # A batch runs to completion; the caller has already stopped waiting for its row
+        pass
+
+    def stats(self):
+        return self.batcher.stats()
@@ -0,0 +1,101 @@
+import datetime
+import json
+import os
+import queue
+import random
+import threading
+
+
+class RequestLog:
+    """Structured JSONL request log written by a background thread.
+
+    The request path only samples, truncates and enqueues a record; a writer thread drains the bounded queue in
+    batches and rotates the file by size (`path.1` ... `path.<backups>`). When the queue is full, records are
+    dropped and counted rather than blocking the server.
+    """
+
+    def __init__(self, path, sample_rate=1.0, max_chars=2000, max_bytes=100 << 20, backups=5, queue_size=10000, batch_size=256):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._rng = random.Random()
+        self._queue = queue.Queue(maxsize=queue_size)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name="request-log", daemon=True)
+        self._thread.start()
+
+    def log(self, record, always=False):
+        # `always` bypasses sampling, e.g. for errors
+        if not always and self.sample_rate < 1.0 and self._rng.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        record = {"time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+                  **{key: self._truncate(value) for key, value in record.items()}}
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.max_chars:
+            return value[:self.max_chars] + f"...[{len(value) - self.max_chars} chars truncated]"
+        return value
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = any(record is None for record in batch)
+            records = [record for record in batch if record is not None]
+            if records:
+                self._file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+                self._file.flush()
+                self.written += len(records)
+                if self._file.tell() >= self.max_bytes:
+                    self._rotate()
+            if closing:
+                self._file.close()
+                return
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def stats(self):
+        return {"written": self.written, "dropped": self.dropped, "sampled_out": self.sampled_out, "queued": self._queue.qsize()}
+
+    def close(self):
+        # Flush everything queued so far and stop the writer; closing twice is harmless
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+def add_request_log_args(parser, default_path):
+    parser.add_argument('--request-log', default=default_path, help=f"JSONL file of logged requests (default: {default_path})")
+    parser.add_argument('--log-sample-rate', type=float, default=1.0, help="Fraction of successful requests that are logged; errors are always logged (default: 1.0)")
+    parser.add_argument('--log-max-chars', type=int, default=2000, help="Prompts and responses are truncated to this many characters (default: 2000)")
+    parser.add_argument('--log-max-mb', type=int, default=100, help="Rotate the request log once it reaches this size (default: 100)")
+    parser.add_argument('--log-backups', type=int, default=5, help="Number of rotated request logs kept (default: 5)")
+
+def request_log_from_args(args):
+    return RequestLog(args.request_log, sample_rate=args.log_sample_rate, max_chars=args.log_max_chars,
+                      max_bytes=args.log_max_mb << 20, backups=args.log_backups)
@@ -0,0 +1,70 @@
+from collections import defaultdict
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class ServingMetrics:
+    """Counters, gauges and histograms rendered in the Prometheus text exposition format.
+
+    Metrics are declared once with `describe` and then updated by name, with labels passed as keyword
+    arguments. Meant for a single-threaded asyncio server, so updates take no lock.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._meta = {}  # name -> (type, help, buckets)
+        self._values = defaultdict(float)  # (name, labels) -> counter or gauge value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+
+    def describe(self, name, kind, help, buckets=DEFAULT_BUCKETS):
+        self._meta[name] = (kind, help, tuple(buckets) if kind == "histogram" else None)
+
+    def inc(self, name, value=1, **labels):
+        self._values[(name, tuple(sorted(labels.items())))] += value
+
+    def dec(self, name, value=1, **labels):
+        self.inc(name, -value, **labels)
+
+    def set(self, name, value, **labels):
+        self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.setdefault(key, [0] * len(buckets) + [0.0, 0])
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def render(self):
+        lines = []
+        for name, (kind, help, buckets) in self._meta.items():
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), histogram in self._histograms.items():
+                    if metric != name:
+                        continue
+                    for bound, count in zip(buckets, histogram):
+                        lines.append(f"{full_name}_bucket{format_labels(labels + (('le', format_value(bound)),))} {count}")
+                    lines.append(f"{full_name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram[-1]}")
+                    lines.append(f"{full_name}_sum{format_labels(labels)} {format_value(histogram[-2])}")
+                    lines.append(f"{full_name}_count{format_labels(labels)} {histogram[-1]}")
+            else:
+                for (metric, labels), value in self._values.items():
+                    if metric == name:
+                        lines.append(f"{full_name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
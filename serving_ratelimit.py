@@ -0,0 +1,134 @@
+import asyncio
+import time
+from collections import namedtuple
+
+# What a call reserved before it was sent: its prompt size in characters, the per-message token overhead, the
+# estimated prompt tokens, the max_tokens it asked for, the tokens taken from the bucket and how long it waited
+Reservation = namedtuple("Reservation", ["chars", "overhead", "prompt_tokens", "max_tokens", "tokens", "wait"])
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators per chat message
+
+
+class TokenBucket:
+    """Refills at `per_minute / 60` per second up to `capacity`. Corrections may take the level below zero."""
+
+    def __init__(self, per_minute, capacity):
+        self.rate = per_minute / 60
+        self.capacity = capacity
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+        return self.level
+
+    def wait_time(self, amount):
+        # Seconds until `amount` is available; more than the capacity only has to wait for a full bucket
+        return max((min(amount, self.capacity) - self.refill()) / self.rate, 0.0)
+
+    def take(self, amount):
+        # A negative amount refunds
+        self.level = min(self.capacity, self.refill() - amount)
+
+
+class RateLimiter:
+    """Paces upstream calls to stay just under a deployment's requests- and tokens-per-minute quotas.
+
+    Before a call is sent, one request and its estimated tokens are taken from two token buckets. The buckets
+    refill at `headroom` times the quota and hold `window_s` seconds of it, which bounds bursts. Callers are
+    served in arrival order. Once the actual `usage` is known, `settle` corrects the token bucket and recalibrates
+    the prompt estimate. Like Azure, the default `max_tokens` accounting charges the requested max_tokens instead
+    of the completion tokens; "usage" charges the completion tokens. A 429 that still gets through pauses every
+    caller for its Retry-After. A quota of 0 is not limited.
+    """
+
+    def __init__(self, rpm=0, tpm=0, headroom=0.9, window_s=10.0, accounting="max_tokens"):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.accounting = accounting
+        self.requests = TokenBucket(rpm * headroom, rpm * headroom * window_s / 60) if rpm else None
+        self.tokens = TokenBucket(tpm * headroom, tpm * headroom * window_s / 60) if tpm else None
+        self.chars_per_token = 4.0  # recalibrated from the actual prompt tokens
+        self.waiting = 0
+        self.throttled = 0
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def estimate(self, messages):
+        chars = sum(len(m["content"]) for m in messages if isinstance(m.get("content"), str))
+        overhead = MESSAGE_OVERHEAD_TOKENS * len(messages)
+        return chars, overhead, int(chars / self.chars_per_token) + overhead
+
+    def _delay(self, tokens):
+        delay = self._paused_until - time.monotonic()
+        if self.requests is not None:
+            delay = max(delay, self.requests.wait_time(1))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.wait_time(tokens))
+        return delay
+
+    async def acquire(self, messages, max_tokens):
+        chars, overhead, prompt_tokens = self.estimate(messages)
+        tokens = prompt_tokens + (max_tokens or 0)
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            # The lock is handed over in FIFO order, so only the head of the queue sleeps on the buckets
+            async with self._lock:
+                while (delay := self._delay(tokens)) > 0:
+                    await asyncio.sleep(delay)
+                if self.requests is not None:
+                    self.requests.take(1)
+                if self.tokens is not None:
+                    self.tokens.take(tokens)
+        finally:
+            self.waiting -= 1
+        return Reservation(chars, overhead, prompt_tokens, max_tokens or 0, tokens, time.monotonic() - started)
+
+    def settle(self, reservation, prompt_tokens, completion_tokens):
+        if reservation.chars and prompt_tokens > reservation.overhead:
+            observed = reservation.chars / (prompt_tokens - reservation.overhead)
+            self.chars_per_token = 0.9 * self.chars_per_token + 0.1 * observed
+        if self.tokens is not None:
+            charged = prompt_tokens + (completion_tokens if self.accounting == "usage" else reservation.max_tokens)
+            self.tokens.take(charged - reservation.tokens)
+
+    def cancel(self, reservation):
+        # The call was rejected or never reached the deployment; its tokens are returned, its request slot is not
+        if self.tokens is not None:
+            self.tokens.take(-reservation.tokens)
+
+    def pause(self, seconds):
+        # The quota is spent whatever the buckets say, so they restart empty once the pause is over
+        self.throttled += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.take(max(bucket.refill(), 0))
+
+    def stats(self):
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "waiting": self.waiting,
+            "paused_seconds": max(self._paused_until - time.monotonic(), 0.0),
+            "requests_available": self.requests.refill() if self.requests is not None else None,
+            "tokens_available": self.tokens.refill() if self.tokens is not None else None,
+            "chars_per_token": self.chars_per_token,
+            "throttled": self.throttled,
+        }
+
+
+def add_rate_limit_args(parser):
+    parser.add_argument("--rpm", type=int, default=0, help="Requests-per-minute quota of the deployment; 0 disables pacing (default: 0)")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens-per-minute quota of the deployment; 0 disables pacing (default: 0)")
+    parser.add_argument("--rate-limit-headroom", type=float, default=0.9, help="Fraction of the quotas to pace at (default: 0.9)")
+    parser.add_argument("--rate-limit-window", type=float, default=10.0, help="Seconds of quota that may be spent in one burst (default: 10)")
+    parser.add_argument("--tpm-accounting", default="max_tokens", choices=["max_tokens", "usage"],
+                        help="Charge completions with the requested max_tokens, as Azure does (default), or with the completion tokens used")
+
+def rate_limiter_from_args(args):
+    return RateLimiter(args.rpm, args.tpm, headroom=args.rate_limit_headroom, window_s=args.rate_limit_window,
+                       accounting=args.tpm_accounting)
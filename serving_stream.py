@@ -0,0 +1,47 @@
+import json
+import time
+import uuid
+
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool
+
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def completion_chunk(completion_id, model, content=None, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {"content": content} if content is not None else {}, "finish_reason": finish_reason}],
+    }
+
+def sse_response(deltas, model="", usage=None, on_close=None):
+    """Serve an iterator of text deltas as OpenAI-style server-sent events ending in `data: [DONE]`.
+
+    `deltas` may be async or sync (iterated in the thread pool). When the client disconnects the iterator is
+    abandoned mid-stream, which is how the servers learn to stop generating. A `usage` dict filled in by the
+    iterator is sent as a final chunk without choices, as OpenAI does with `include_usage`. `on_close` is called
+    once the response has ended, whether it completed or the client went away.
+    """
+    if not hasattr(deltas, "__aiter__"):
+        deltas = iterate_in_threadpool(deltas)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+    async def events():
+        try:
+            async for content in deltas:
+                if content:
+                    yield sse_event(completion_chunk(completion_id, model, content))
+            yield sse_event(completion_chunk(completion_id, model, finish_reason="stop"))
+            if usage is not None:
+                yield sse_event({**completion_chunk(completion_id, model), "choices": [], "usage": usage})
+        except Exception as e:
+            # Headers are already sent, so a failure can only be reported in-band
+            yield sse_event({"error": str(e)})
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", background=BackgroundTask(on_close) if on_close else None)